@@ -0,0 +1,111 @@
+import math
+import time
+import asyncio
+import selectors
+
+# MicroPython ticks wrap around at 2**30
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALF = TICKS_PERIOD // 2
+
+
+def ticks_diff(a, b):
+    return ((a - b + TICKS_HALF) & TICKS_MAX) - TICKS_HALF
+
+
+def ticks_add(a, b):
+    return (a + b) & TICKS_MAX
+
+
+class WallClock:
+    """ MicroPython time functions on the host's clock. Ticks start at
+    `ticks_start` ms, so wrap-around can be reached in a short run. """
+
+    def __init__(self, ticks_start=0):
+        self.start = time.monotonic()
+        self.ticks_start = ticks_start
+
+    def install(self):
+        time.ticks_ms = lambda: (self.ticks_start + int((time.monotonic() - self.start) * 1000)) & TICKS_MAX
+        time.ticks_us = lambda: (self.ticks_start * 1000 + int((time.monotonic() - self.start) * 1000000)) & TICKS_MAX
+        time.ticks_diff = ticks_diff
+        time.ticks_add = ticks_add
+        time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+
+
+class VirtualClock:
+    """ Discrete-event clock. Sleeping and waiting on the event loop advance
+    simulated time at once instead of waiting, so a run only takes as long
+    as the work done in it and is the same every time.
+
+    `time.time()` starts at `epoch`. After `duration` simulated seconds the
+    clock raises KeyboardInterrupt, which stops main.py the same way as
+    Ctrl-C does. """
+
+    def __init__(self, epoch=1767225600, ticks_start=0, duration=None):
+        self.epoch = epoch  # 2026-01-01 00:00 UTC
+        self.ticks_start = ticks_start
+        self.duration = duration
+        self.now_us = 0  # Simulated µs since the start
+
+    def install(self):
+        time.ticks_ms = self.ticks_ms
+        time.ticks_us = self.ticks_us
+        time.ticks_diff = ticks_diff
+        time.ticks_add = ticks_add
+        time.sleep_ms = lambda ms: self.advance(ms / 1000)
+        time.sleep = self.advance
+        time.time = self.time
+        asyncio.set_event_loop_policy(VirtualEventLoopPolicy(self))
+
+    def ticks_ms(self):
+        return (self.ticks_start + self.now_us // 1000) & TICKS_MAX
+
+    def ticks_us(self):
+        return (self.ticks_start * 1000 + self.now_us) & TICKS_MAX
+
+    def time(self):
+        return self.epoch + self.now_us / 1000000
+
+    def monotonic(self):
+        return self.now_us / 1000000
+
+    def advance(self, seconds):
+        self.now_us += math.ceil(seconds * 1000000)
+        if self.duration is not None and self.now_us >= self.duration * 1000000:
+            raise KeyboardInterrupt
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """ Polls the real sockets without blocking. When nothing is ready the
+    wait the event loop asked for passes on the virtual clock instead. """
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        if timeout is None:
+            return super().select(None)  # Nothing scheduled, wait for real I/O
+        events = super().select(0)
+        if not events and timeout > 0:
+            self.clock.advance(timeout)
+        return events
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(VirtualSelector(clock))
+        self._virtual_clock = clock
+
+    def time(self):
+        return self._virtual_clock.monotonic()
+
+
+class VirtualEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def new_event_loop(self):
+        return VirtualEventLoop(self.clock)
@@ -2,8 +2,8 @@ TEMPERATURES = {}
 
 
 class DS18X20:
-    def __init__(self, pin):
-        self.pin = pin
+    def __init__(self, onewire):
+        self.ow = onewire
 
     def scan(self):
         # Simulate scanning for devices on the bus
@@ -13,6 +13,10 @@ class DS18X20:
         # Simulate reading temperature from a device
         return TEMPERATURES.get(rom, None)
 
+    def write_scratch(self, rom, buf):
+        # Simulate writing alarm and resolution registers
+        pass
+
     def set_temp(self, rom, temp):
         # Simulate setting a temperature for a device
         TEMPERATURES[rom] = temp
@@ -1,24 +1,83 @@
+import asyncio
+
 
 class Pin:
-    def __init__(self, pin_nr, direction='input', value=0):
+    pins = {}  # Pin number to the last Pin created for it
+    listener = None  # Called with the pin before an output changes
+
+    def __init__(self, pin_nr, direction='input', pull=None, value=0):
         self.pin_nr = pin_nr
         self.direction = direction
-        self.internal_value = value
+        self.internal_value = 1 if pull == Pin.PULL_UP else value
+        self.handler = None
+        Pin.pins[pin_nr] = self
 
-    def value(self, value):
+    def value(self, value=None):
+        if value is None:
+            return self.internal_value
         if self.direction != 'output':
             raise ValueError("Cannot set value on an input pin")
+        if Pin.listener is not None and value != self.internal_value:
+            Pin.listener(self)
         self.internal_value = value
 
     def get_value(self):
         if self.direction != 'input':
             raise ValueError("Cannot get value from an output pin")
         return self.internal_value
-    
+
+    def irq(self, trigger=None, handler=None):
+        # Only falling edges are simulated
+        self.handler = handler
+
+    def drive(self, value):
+        """ Sets an input from the outside, e.g. the plant model. """
+        falling = self.internal_value and not value
+        self.internal_value = value
+        if falling and self.handler is not None:
+            self.handler(self)
+
+
+class Timer:
+    """ Runs the callback on the asyncio loop, so it follows the virtual
+    clock too. Like a soft timer callback on the ESP32. """
+
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id):
+        self.id = id
+        self._handle = None
+
+    def init(self, mode=ONE_SHOT, period=-1, callback=None):
+        self.deinit()
+        loop = asyncio.get_running_loop()
+
+        def fire():
+            if mode == Timer.PERIODIC:
+                self._handle = loop.call_later(period / 1000, fire)
+            else:
+                self._handle = None
+            callback(self)
+        self._handle = loop.call_later(period / 1000, fire)
+
+    def deinit(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class RTC:
+    def datetime(self, datetimetuple=None):
+        # The host clock is used as it is
+        pass
+
 
 def reset():
     print("Machine reset called")
 
 
 Pin.OUT = 'output'
-Pin.IN = 'input'
\ No newline at end of file
+Pin.IN = 'input'
+Pin.PULL_UP = 1
+Pin.IRQ_FALLING = 2
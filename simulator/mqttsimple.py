@@ -0,0 +1,63 @@
+import time
+
+
+class MQTTClient:
+    # time.time() until which the broker refuses connections, see simulate.py
+    down_until = 0
+
+    def __init__(self, client_id, server, port=1883, user=None, password=None, keepalive=60,
+                 window=8):
+        self.client_id = client_id
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.keepalive = keepalive
+        self.window = window
+        self.rx_pid = 0
+        self.rx_code = 0
+
+    def connect(self):
+        # Simulate connecting to the MQTT broker
+        pass
+
+    def begin_connect(self):
+        # Simulate starting a non-blocking connect
+        if time.time() < MQTTClient.down_until:
+            raise OSError(111)  # ECONNREFUSED
+
+    def poll_connect(self):
+        # Simulate the CONNACK, session present flag
+        return 0
+
+    def abort_connect(self):
+        # Simulate closing a connection attempt
+        pass
+
+    def disconnect(self):
+        # Simulate disconnecting from the MQTT broker
+        pass
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        # Simulate publishing a message to a topic, QoS 1 is acknowledged at once
+        return 1 if qos else None
+
+    def inflight(self):
+        # Simulate the QoS 1 messages waiting for a PUBACK
+        return 0
+
+    def publish_many(self, msgs, retain=False):
+        # Simulate publishing a batch of messages in one write
+        pass
+
+    def subscribe(self, topic, qos=0, wait=True):
+        # Simulate subscribing to a topic
+        pass
+
+    def check_msg(self):
+        # Simulate checking for incoming messages
+        pass
+
+    def set_callback(self, callback):
+        # Simulate setting a callback for incoming messages
+        pass
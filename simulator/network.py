@@ -23,6 +23,10 @@ class WLAN:
             print("WLAN is not active or not in station mode.")
             return False
 
+    def disconnect(self):
+        # Simulate leaving the network
+        pass
+
     def isconnected(self):
         # Simulate checking connection status
         return self.is_active
@@ -0,0 +1,160 @@
+import math
+import time
+
+import ds18x20
+from machine import Pin
+
+CP_WATER = 4186  # J/(kg K)
+STEP = 1.0  # s, longest integration step
+
+
+def constant_profile(t):
+    return 0.0
+
+
+def daily_profile(t):
+    # Coldest at 05:00, warmest at 17:00
+    return -2.0 + 5.0 * math.sin(2 * math.pi * (t / 3600 - 11) / 24)
+
+
+def cold_front_profile(t):
+    # A mild day, then the temperature drops by 15 °C over two hours
+    drop = min(max((t - 6 * 3600) / 7200, 0.0), 1.0)
+    return daily_profile(t) + 5.0 - 15.0 * drop
+
+
+PROFILES = {
+    "constant": constant_profile,
+    "daily": daily_profile,
+    "cold_front": cold_front_profile,
+}
+
+
+class Plant:
+    """ District heating substation and the building behind it.
+
+    The primary side flow follows the valve opening, which is integrated
+    from the open and close relay pins (active low) with the stroke time of
+    the actuator. Optional end stop switches pull their pins low at the
+    stops. A counterflow heat exchanger passes heat to the secondary
+    circuit, which only flows with the pump on. The radiators heat a
+    building with one lumped thermal mass that loses heat to the outdoor
+    air. Heat exchanger outlets and sensors follow with first order lags.
+
+    `update()` integrates up to the current ticks_ms and writes the sensor
+    readings into ds18x20.TEMPERATURES. """
+
+    def __init__(self, pump, roms, profile="daily", valve_pins=(19, 18),
+                 end_stop_pins=None, stroke_time=150.0, start_hour=0.0):
+        self.pump = pump  # Callable, True while the pump runs
+        self.roms = roms  # Sensor name to ROM code
+        self.outdoor = PROFILES[profile]
+        self.open_pin, self.close_pin = valve_pins
+        self.end_stop_pins = end_stop_pins  # (closed, open), pulled low at the stop
+        self.start_time = start_hour * 3600
+
+        # Valve actuator and primary side
+        self.stroke_time = stroke_time  # s from closed to open
+        self.primary_flow_max = 0.4  # kg/s with the valve open
+        self.hx_ua = 5000.0  # W/K
+        self.hx_time_constant = 30.0  # s
+
+        # Secondary side and building, sized for about 30 kW at -20 °C
+        self.secondary_flow = 0.5  # kg/s with the pump running
+        self.standby_flow = 0.005  # kg/s of natural circulation without the pump
+        self.radiator_ua = 1150.0  # W/K
+        self.building_ua = 730.0  # W/K to the outdoor air
+        self.building_capacity = 150e6  # J/K
+        self.sensor_time_constant = 10.0  # s
+
+        self.valve = 0.0  # Opening 0..1
+        self.indoor = 21.0
+        outdoor = self.outdoor(self.start_time)
+        self.primary_supply = self._primary_supply(outdoor)
+        self.primary_return = 25.0
+        self.secondary_supply = 25.0
+        self.secondary_return = 25.0
+        self.readings = {
+            "ambient_temp": outdoor,
+            "primary_supply_temp": self.primary_supply,
+            "primary_return_temp": self.primary_return,
+            "secondary_supply_temp": self.secondary_supply,
+            "secondary_return_temp": self.secondary_return,
+        }
+        self.elapsed = 0.0  # s since start
+        self.last_ticks = time.ticks_ms()
+        self._publish()
+
+    def _primary_supply(self, outdoor):
+        # The district heating plant raises its supply temperature in the cold
+        return min(90.0, max(70.0, 75.0 - 0.5 * outdoor))
+
+    def _driven(self, pin_nr):
+        # The relays pull the pins low
+        pin = Pin.pins.get(pin_nr)
+        return pin is not None and pin.internal_value == 0
+
+    def update(self):
+        now = time.ticks_ms()
+        dt = time.ticks_diff(now, self.last_ticks) / 1000
+        self.last_ticks = now
+        while dt > 0:
+            step = min(dt, STEP)
+            self._step(step)
+            dt -= step
+        self._publish()
+
+    def _step(self, dt):
+        self.elapsed += dt
+        opening = self._driven(self.open_pin)
+        closing = self._driven(self.close_pin)
+        if opening and not closing:
+            self.valve = min(1.0, self.valve + dt / self.stroke_time)
+        elif closing and not opening:
+            self.valve = max(0.0, self.valve - dt / self.stroke_time)
+        if self.end_stop_pins is not None:
+            for pin_nr, end in zip(self.end_stop_pins, (0.0, 1.0)):
+                pin = Pin.pins.get(pin_nr)
+                if pin is not None:
+                    pin.drive(0 if self.valve == end else 1)
+
+        outdoor = self.outdoor(self.start_time + self.elapsed)
+        self.primary_supply = self._primary_supply(outdoor)
+        primary = max(self.primary_flow_max * self.valve, 1e-6) * CP_WATER
+        secondary = (self.secondary_flow if self.pump() else self.standby_flow) * CP_WATER
+
+        # Counterflow effectiveness with the return water of both sides
+        c_min = min(primary, secondary)
+        c_ratio = c_min / max(primary, secondary)
+        ntu = self.hx_ua / c_min
+        if c_ratio < 0.999:
+            e = math.exp(-ntu * (1 - c_ratio))
+            effectiveness = (1 - e) / (1 - c_ratio * e)
+        else:
+            effectiveness = ntu / (1 + ntu)
+        heat = effectiveness * c_min * (self.primary_supply - self.secondary_return)
+        hx_primary_out = self.primary_supply - heat / primary
+        hx_secondary_out = self.secondary_return + heat / secondary
+
+        k = dt / self.hx_time_constant
+        self.primary_return += k * (hx_primary_out - self.primary_return)
+        self.secondary_supply += k * (hx_secondary_out - self.secondary_supply)
+
+        # Radiators cool the supply water towards the indoor temperature
+        radiator_out = self.indoor + (self.secondary_supply - self.indoor) * math.exp(-self.radiator_ua / secondary)
+        radiator_heat = secondary * (self.secondary_supply - radiator_out)
+        self.secondary_return += k * (radiator_out - self.secondary_return)
+        self.indoor += dt * (radiator_heat - self.building_ua * (self.indoor - outdoor)) / self.building_capacity
+
+        k = dt / self.sensor_time_constant
+        readings = self.readings
+        readings["ambient_temp"] += k * (outdoor - readings["ambient_temp"])
+        readings["primary_supply_temp"] += k * (self.primary_supply - readings["primary_supply_temp"])
+        readings["primary_return_temp"] += k * (self.primary_return - readings["primary_return_temp"])
+        readings["secondary_supply_temp"] += k * (self.secondary_supply - readings["secondary_supply_temp"])
+        readings["secondary_return_temp"] += k * (self.secondary_return - readings["secondary_return_temp"])
+
+    def _publish(self):
+        # DS18B20 resolution is 1/16 °C
+        for name, rom in self.roms.items():
+            ds18x20.TEMPERATURES[rom] = round(self.readings[name] * 16) / 16
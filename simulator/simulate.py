@@ -1,43 +1,92 @@
 import sys
 import os
+import json
 import time
 
 # Add the src directory to Python path
-sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+SRC_DIR = os.path.join(os.path.dirname(__file__), '..', 'src')
+sys.path.append(SRC_DIR)
 
-start_time = time.time()
+import clock
 
-time.ticks_ms = lambda: int((time.time() - start_time) * 1000)
-time.sleep_ms = lambda t: time.sleep(t / 1000)
-time.ticks_diff = lambda a, b: a - b
+# SIM_CLOCK=virtual runs on simulated time as fast as possible, stopping
+# after SIM_DURATION simulated seconds. SIM_TICKS_START sets the first
+# ticks_ms value, e.g. 1073681824 to wrap around a minute into the run.
+ticks_start = int(os.environ.get("SIM_TICKS_START", "0"))
+if os.environ.get("SIM_CLOCK") == "virtual":
+    duration = os.environ.get("SIM_DURATION")
+    sim_clock = clock.VirtualClock(
+        ticks_start=ticks_start,
+        duration=float(duration) if duration else None)
+    # A full CPython collection every simulated second would take most of
+    # the run time, and CPython collects on its own anyway
+    import gc
+    gc.collect = lambda: 0
+else:
+    sim_clock = clock.WallClock(ticks_start=ticks_start)
+sim_clock.install()
+wall_start = time.monotonic()
 
-import pump
-pump.mock_power = False
-def mock_get_shelly_status():
+# Seeded, so the backoff jitter is the same in every run
+import random
+random.seed(int(os.environ.get("SIM_SEED", "0")))
+
+import shelly_client
+shelly_client.mock_power = False
+async def mock_get_switch_status(self):
     return {
-        "result": {
-            "switch:0": {
-                "output": pump.mock_power,
-                "aenergy": {
-                    "total": 12345.67
-                }
-            }
+        "output": shelly_client.mock_power,
+        "aenergy": {
+            "total": 12345.67
         }
     }
-pump.get_shelly_status = mock_get_shelly_status
+shelly_client.ShellyClient.get_switch_status = mock_get_switch_status
+
+async def mock_set_switch(self, on):
+    shelly_client.mock_power = on
+shelly_client.ShellyClient.set_switch = mock_set_switch
 
-def set_shelly_power(on):
-    pump.mock_power = on
-pump.set_shelly_power = set_shelly_power
 
+# SIM_BROKER_DOWN refuses MQTT connections for that many simulated seconds
+import mqttsimple
+mqttsimple.MQTTClient.down_until = time.time() + float(os.environ.get("SIM_BROKER_DOWN", "0"))
+
+import http_view
+http_view.UI_PATH = os.path.join(SRC_DIR, 'www', 'index.html.gz')
 
 import ds18x20
-ds18x20.TEMPERATURES = {
-    '1' : -8.0,
-    '2' : 23.0,
-    '3' : 21.8,
-    '4' : 22.1,
-    '5' : 23.3
-}
+import machine
+import plant
+
+# The sensor readings come from the plant model, which follows the valve
+# relays and the pump. Pick the outdoor profile with PLANT_PROFILE and the
+# real valve stroke time with PLANT_STROKE_TIME.
+with open("settings.json") as f:
+    settings = json.load(f)
+model = plant.Plant(
+    pump=lambda: shelly_client.mock_power,
+    roms={
+        "ambient_temp": b'1',
+        "primary_supply_temp": b'2',
+        "primary_return_temp": b'3',
+        "secondary_supply_temp": b'4',
+        "secondary_return_temp": b'5',
+    },
+    profile=os.environ.get("PLANT_PROFILE", "daily"),
+    end_stop_pins=settings.get("valve", {}).get("end_stops"),
+    stroke_time=float(os.environ.get("PLANT_STROKE_TIME", "150")))
+
+read_temp = ds18x20.DS18X20.read_temp
+def plant_read_temp(self, rom):
+    model.update()
+    return read_temp(self, rom)
+ds18x20.DS18X20.read_temp = plant_read_temp
+
+# Integrate up to every relay change, so valve pulses are exact
+machine.Pin.listener = lambda pin: model.update()
 
 import main
+
+print(f"Plant after {model.elapsed / 3600:.2f} h in {time.monotonic() - wall_start:.1f} s: "
+      f"indoor {model.indoor:.2f} °C, valve {model.valve * 150:.1f}/150, "
+      f"tracked {main.valve.position:.1f}/150")
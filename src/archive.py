@@ -0,0 +1,233 @@
+import os
+import time
+import struct
+from array import array
+import log
+
+logger = log.get_logger("archive")
+
+BLOCK_MAGIC = 0xA5
+BLOCK_HEADER = "<BBHL"  # magic, record count, payload length, time of first record
+BLOCK_HEADER_SIZE = 8
+INDEX_ENTRY = "<LL"  # time of first record, block offset in the segment
+INDEX_ENTRY_SIZE = 8
+
+
+def _put_varint(buf, pos, n):
+    while n > 0x7f:
+        buf[pos] = (n & 0x7f) | 0x80
+        n >>= 7
+        pos += 1
+    buf[pos] = n
+    return pos + 1
+
+
+def _get_varint(buf, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return n, pos
+        shift += 7
+
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+
+def _unzigzag(n):
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+class _Reader:
+    """ Buffers of one rows() call. """
+
+    def __init__(self, block_size, columns):
+        self.entry = bytearray(INDEX_ENTRY_SIZE)
+        self.header = bytearray(BLOCK_HEADER_SIZE)
+        self.block = bytearray(block_size)
+        self.values = [0] * columns
+
+
+class Archive:
+    """ Append-only sample archive on flash, in rotating fixed-size segment
+    files. Samples are buffered in RAM and written as one block about once
+    a minute. Within a block the time and every column are stored as
+    zigzag varint deltas to the previous sample, so a block can be decoded
+    on its own. Every segment has an index file with the first time and
+    offset of each block, which lets a range query seek straight to the
+    first block it needs. The index entry is written after its block, so
+    a block cut short by a power loss is never referenced. """
+
+    def __init__(self, columns, directory="archive", segment_size=65536,
+                 max_segments=8, block_size=512, flush_interval=60000):
+        self.columns = columns
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.flush_interval = flush_interval
+
+        self._block = bytearray(block_size)
+        self._block_len = 0
+        self._count = 0
+        self._first_time = 0
+        self._prev_time = 0
+        self._prev_values = array('l', [0] * columns)
+        self._flush_time = time.ticks_ms()
+        self._entry = bytearray(INDEX_ENTRY_SIZE)
+
+        try:
+            os.mkdir(directory)
+        except OSError:
+            pass  # Already exists
+        segments = self._segments()
+        self._segment = segments[-1] if segments else 0
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith("seg") and name.endswith(".bin"):
+                segments.append(int(name[3:-4]))
+        segments.sort()
+        return segments
+
+    def _path(self, segment, ext):
+        return "%s/seg%08d.%s" % (self.directory, segment, ext)
+
+    def append(self, t, values):
+        # Worst case record: 5 bytes of time delta and 3 bytes per column
+        if self._block_len + 5 + 3 * self.columns > len(self._block) or self._count == 255:
+            self.flush()
+        buf = self._block
+        pos = self._block_len
+        if self._count == 0:
+            self._first_time = t
+            self._prev_time = t
+            for i in range(self.columns):
+                self._prev_values[i] = 0
+        pos = _put_varint(buf, pos, max(0, t - self._prev_time))
+        for i in range(self.columns):
+            pos = _put_varint(buf, pos, _zigzag(values[i] - self._prev_values[i]))
+            self._prev_values[i] = values[i]
+        self._prev_time = t
+        self._block_len = pos
+        self._count += 1
+        if time.ticks_diff(time.ticks_ms(), self._flush_time) >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._flush_time = time.ticks_ms()
+        if not self._count:
+            return
+        try:
+            self._write_block()
+        except OSError as e:
+            logger.error("Failed to write archive block: %s", e)
+        self._block_len = 0
+        self._count = 0
+
+    def _write_block(self):
+        size = BLOCK_HEADER_SIZE + self._block_len
+        try:
+            offset = os.stat(self._path(self._segment, "bin"))[6]
+        except OSError:
+            offset = 0
+        if offset and offset + size > self.segment_size:
+            self._segment += 1
+            offset = 0
+            self._rotate()
+        header = struct.pack(BLOCK_HEADER, BLOCK_MAGIC, self._count, self._block_len, self._first_time)
+        with open(self._path(self._segment, "bin"), "ab") as f:
+            f.write(header)
+            f.write(memoryview(self._block)[:self._block_len])
+        with open(self._path(self._segment, "idx"), "ab") as f:
+            f.write(struct.pack(INDEX_ENTRY, self._first_time, offset))
+
+    def _rotate(self):
+        segments = self._segments()
+        # The new segment is not on flash yet, so keep one less
+        while len(segments) >= self.max_segments:
+            oldest = segments.pop(0)
+            for ext in ("bin", "idx"):
+                try:
+                    os.remove(self._path(oldest, ext))
+                except OSError:
+                    pass
+
+    def _first_entry(self, segment):
+        try:
+            with open(self._path(segment, "idx"), "rb") as f:
+                if f.readinto(self._entry) == INDEX_ENTRY_SIZE:
+                    return struct.unpack(INDEX_ENTRY, self._entry)
+        except OSError:
+            pass
+        return None
+
+    def rows(self, start=None, end=None):
+        """ Yields (time, values) for the archived samples between `start`
+        and `end`, inclusive. Only one block is held in RAM at a time and
+        the values list is reused for every row. The buffers belong to the
+        call, so exports running at the same time do not mix. """
+        reader = _Reader(len(self._block), self.columns)
+        segments = self._segments()
+        for n, segment in enumerate(segments):
+            if n + 1 < len(segments) and start is not None:
+                following = self._first_entry(segments[n + 1])
+                if following is not None and following[0] <= start:
+                    continue  # Everything in this segment is older
+            first = self._first_entry(segment)
+            if first is None:
+                continue
+            if end is not None and first[0] > end:
+                return
+            for row in self._segment_rows(reader, segment, start, end):
+                yield row
+
+    def _segment_rows(self, reader, segment, start, end):
+        # Blocks are located through the index only, so bytes left behind
+        # by a torn write between two blocks are never parsed.
+        with open(self._path(segment, "idx"), "rb") as index, \
+                open(self._path(segment, "bin"), "rb") as data:
+            before = None  # Last block starting at or before `start`
+            while index.readinto(reader.entry) == INDEX_ENTRY_SIZE:
+                block_time, offset = struct.unpack(INDEX_ENTRY, reader.entry)
+                if end is not None and block_time > end:
+                    break
+                if start is not None and block_time <= start:
+                    before = offset
+                    continue
+                if before is not None:
+                    yield from self._block_rows(reader, data, before, start, end)
+                    before = None
+                yield from self._block_rows(reader, data, offset, start, end)
+            if before is not None:
+                yield from self._block_rows(reader, data, before, start, end)
+
+    def _block_rows(self, reader, data, offset, start, end):
+        data.seek(offset)
+        header = reader.header
+        if data.readinto(header) != BLOCK_HEADER_SIZE:
+            return
+        magic, count, length, t = struct.unpack(BLOCK_HEADER, header)
+        if magic != BLOCK_MAGIC or length > len(reader.block):
+            return
+        buf = memoryview(reader.block)[:length]
+        if data.readinto(buf) != length:
+            return
+        values = reader.values
+        for i in range(self.columns):
+            values[i] = 0
+        pos = 0
+        for _ in range(count):
+            dt, pos = _get_varint(buf, pos)
+            t += dt
+            for i in range(self.columns):
+                delta, pos = _get_varint(buf, pos)
+                values[i] += _unzigzag(delta)
+            if end is not None and t > end:
+                return
+            if start is None or t >= start:
+                yield t, values
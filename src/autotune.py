@@ -0,0 +1,268 @@
+import json
+from array import array
+from events import REGULATOR
+from regulator import Regulator, VALVE_MIN, VALVE_MAX
+import log
+
+logger = log.get_logger("autotune")
+
+SAMPLE_INTERVAL = 5  # s between recorded supply temperatures
+MAX_SAMPLES = 480  # 40 minutes of step response
+BASELINE_SAMPLES = 24  # The supply temperature must hold for 2 minutes before the step
+SETTLE_SAMPLES = 36  # and for 3 minutes at the end of the response
+STEADY_BAND = 0.3  # °C the temperature may wander and still count as steady
+MAX_WAIT = 1800  # s to wait for a steady start
+STEP = 15.0  # s of valve run for the step
+MIN_RESPONSE = 1.0  # °C, smaller responses are too close to the sensor noise to fit
+
+
+class Autotune:
+    """ Step response tuning of the regulator. `start()` waits until the
+    building supply temperature is steady, moves the valve by one step and
+    records the response. A first order plus dead time model is fitted to
+    it with the two point method: the times the response reaches 28.3 % and
+    63.2 % of its final change give the time constant and the dead time,
+    the final change over the valve run gives the process gain.
+
+    The recommended parameters for the current algorithm follow from the
+    model with the SIMC rules and wait in `recommendation` until
+    `approve()` applies them or `discard()` drops them. The regulator holds
+    the valve while a tuning runs. `run()` is called once a second. """
+
+    def __init__(self, regulator):
+        self.regulator = regulator
+        self.state = Autotune.IDLE
+        self.reason = ""  # Why the last tuning failed
+        self.events = None  # Set by SystemController
+
+        # Fitted model, 0 until the first tuning
+        self.process_gain = 0.0  # °C per s of valve run
+        self.dead_time = 0.0  # s
+        self.time_constant = 0.0  # s
+        self.recommendation = None  # Parameter name to value, waiting for approval
+
+        self._samples = array('f', [0.0] * MAX_SAMPLES)
+        self._count = 0
+        self._seconds = 0
+        self._waited = 0
+        self._baseline = 0.0
+        self._final = 0.0  # Mean of the settled response
+        self._band = 0.0  # Spread of the baseline readings
+        self._step = 0.0  # Signed valve run of the step
+        self._position = 0.0  # Valve position the tuning expects
+
+    def start(self):
+        if self.state in (Autotune.WAITING, Autotune.RECORDING):
+            return
+        valve = self.regulator.valve
+        if valve.calibration is not None or valve.adjusting:
+            logger.warning("Valve busy, autotune not started")
+            return
+        logger.info("Autotune started")
+        self.regulator.hold = True
+        self.regulator.pump.start()
+        self.recommendation = None
+        self._count = 0
+        self._seconds = 0
+        self._waited = 0
+        self._position = valve.position
+        self._set_state(Autotune.WAITING)
+
+    def abort(self):
+        if self.state in (Autotune.WAITING, Autotune.RECORDING):
+            self._fail("aborted")
+
+    def approve(self):
+        if self.state != Autotune.DONE:
+            return
+        regulator = self.regulator
+        for name, value in self.recommendation.items():
+            getattr(regulator, "set_" + name)(value)
+        logger.info("Autotune parameters applied: %s", self.recommendation)
+        self.recommendation = None
+        self._set_state(Autotune.IDLE)
+
+    def discard(self):
+        if self.state in (Autotune.DONE, Autotune.FAILED):
+            self.recommendation = None
+            self._set_state(Autotune.IDLE)
+
+    def run(self):
+        if self.state not in (Autotune.WAITING, Autotune.RECORDING):
+            return
+        regulator = self.regulator
+        valve = regulator.valve
+        if valve.calibration is not None:
+            self._fail("valve calibrating")
+            return
+        moving = valve.opening or valve.closing
+        if not moving and abs(valve.position - self._position) > 0.5:
+            self._fail("valve moved")
+            return
+        self._seconds += 1
+        if self._seconds < SAMPLE_INTERVAL:
+            return
+        self._seconds = 0
+        sensor = regulator.secondary_supply_temp
+        if sensor.is_stale():
+            self._fail("sensor stale")
+            return
+        self._samples[self._count] = sensor.value()
+        self._count += 1
+        if self.state == Autotune.WAITING:
+            self._wait()
+        else:
+            self._record()
+
+    def _wait(self):
+        self._waited += SAMPLE_INTERVAL
+        if self._count < BASELINE_SAMPLES:
+            return
+        valve = self.regulator.valve
+        low, high, mean = self._spread(0, BASELINE_SAMPLES)
+        if high - low > STEADY_BAND or valve.opening or valve.closing:
+            if self._waited >= MAX_WAIT:
+                self._fail("not steady")
+                return
+            # Slide the window by one sample
+            samples = self._samples
+            for i in range(BASELINE_SAMPLES - 1):
+                samples[i] = samples[i + 1]
+            self._count -= 1
+            return
+        self._baseline = mean
+        self._band = high - low
+        # Step towards the end with more room, so no end stop is reached
+        if valve.position <= (VALVE_MIN + VALVE_MAX) / 2:
+            self._step = min(STEP, valve.run_time(VALVE_MAX - valve.position) / 2)
+        else:
+            self._step = -min(STEP, valve.run_time(valve.position - VALVE_MIN) / 2)
+        logger.info("Autotune step %.1f s from %.2f °C", self._step, mean)
+        self._position = valve.position + self._step * VALVE_MAX / valve.stroke_time
+        valve.adjust(self._step)
+        self._count = 0
+        self._set_state(Autotune.RECORDING)
+
+    def _record(self):
+        count = self._count
+        if count >= SETTLE_SAMPLES:
+            low, high, _ = self._spread(count - SETTLE_SAMPLES, count)
+            settled = high - low <= STEADY_BAND
+        else:
+            settled = False
+        if settled or count >= MAX_SAMPLES:
+            self._fit()
+
+    def _spread(self, first, end):
+        samples = self._samples
+        low = high = samples[first]
+        total = 0.0
+        for i in range(first, end):
+            value = samples[i]
+            low = min(low, value)
+            high = max(high, value)
+            total += value
+        return low, high, total / (end - first)
+
+    def _crossing(self, level):
+        # First time the response passes `level` of its final change, with
+        # linear interpolation between the samples
+        samples = self._samples
+        change = self._final - self._baseline
+        previous = 0.0
+        for i in range(self._count):
+            fraction = (samples[i] - self._baseline) / change
+            if fraction >= level:
+                t = (i + (level - previous) / (fraction - previous)) * SAMPLE_INTERVAL
+                return t
+            previous = fraction
+        return self._count * SAMPLE_INTERVAL
+
+    def _fit(self):
+        count = self._count
+        _, _, self._final = self._spread(count - SETTLE_SAMPLES // 3, count)
+        change = self._final - self._baseline
+        if abs(change) < max(MIN_RESPONSE, 4 * self._band):
+            self._fail("no response")
+            return
+        gain = change / self._step
+        if gain <= 0:
+            self._fail("wrong direction")
+            return
+        t28 = self._crossing(0.283)
+        t63 = self._crossing(0.632)
+        time_constant = 1.5 * (t63 - t28)
+        # The valve moves as a ramp, which acts like a step half way through
+        dead_time = max(0.0, t63 - time_constant - abs(self._step) / 2)
+        self._set_model(gain, dead_time, time_constant)
+        self.recommendation = self._recommend()
+        logger.info("Autotune fit K %.3f °C/s, dead time %.0f s, time constant %.0f s, recommended %s",
+                    gain, dead_time, time_constant, self.recommendation)
+        self.regulator.hold = False
+        self._set_state(Autotune.DONE)
+
+    def _recommend(self):
+        """ SIMC tuning with the closed loop time constant set to the
+        effective dead time, which includes half a control interval. """
+        regulator = self.regulator
+        gain = self.process_gain
+        if regulator.algorithm == Regulator.P:
+            # Every adjustment_interval the P mode moves the valve by the
+            # gain times the error, which makes it an integrating controller.
+            # The interval is the time a move takes to show, and every move
+            # corrects half of the error.
+            interval = self.dead_time + self.time_constant
+            interval = max(30, min(900, int(round(interval / 10)) * 10))
+            proportional_gain = 1 / (2 * gain)
+            threshold = max(1.0, proportional_gain * 2 * max(self._band, 0.0625))
+            return {
+                "proportional_gain": round(proportional_gain, 2),
+                "adjustment_interval": interval,
+                "adjustment_threshold": round(threshold, 1),
+            }
+        dead_time = self.dead_time + regulator.control_interval / 2
+        return {
+            "proportional_gain": round(self.time_constant / (gain * 2 * dead_time), 2),
+            "integral_time": round(min(self.time_constant, 8 * dead_time)),
+        }
+
+    def _set_model(self, gain, dead_time, time_constant):
+        self.process_gain = gain
+        self.dead_time = dead_time
+        self.time_constant = time_constant
+        self._emit("autotune_process_gain", gain)
+        self._emit("autotune_dead_time", dead_time)
+        self._emit("autotune_time_constant", time_constant)
+
+    def _fail(self, reason):
+        logger.warning("Autotune failed: %s", reason)
+        self.reason = reason
+        self.regulator.hold = False
+        self._set_state(Autotune.FAILED)
+
+    def _set_state(self, state):
+        self.state = state
+        self._emit("autotune_state", state)
+        self._emit("autotune_result", self.result())
+
+    def result(self):
+        """ The fitted model and the recommendation as JSON. """
+        return json.dumps({
+            "state": self.state,
+            "reason": self.reason if self.state == Autotune.FAILED else "",
+            "process_gain": self.process_gain,
+            "dead_time": self.dead_time,
+            "time_constant": self.time_constant,
+            "recommendation": self.recommendation,
+        })
+
+    def _emit(self, name, value):
+        if self.events is not None:
+            self.events.emit(REGULATOR, name, value)
+
+Autotune.IDLE = "idle"
+Autotune.WAITING = "waiting"  # For a steady supply temperature
+Autotune.RECORDING = "recording"  # The step response
+Autotune.DONE = "done"  # Waiting for approval
+Autotune.FAILED = "failed"
+Autotune.ACTIONS = ("start", "abort", "approve", "discard")  # Commands over HTTP and MQTT
@@ -0,0 +1,110 @@
+import os
+import time
+import struct
+from array import array
+from history import MISSING
+from metrics import metrics
+import log
+
+logger = log.get_logger("backfill")
+
+SPILL_FILE = "backfill.bin"
+
+
+class Backfill:
+    """ Telemetry samples taken while the broker is unreachable, for replay
+    once it is back. The samples have the columns of `history` and are
+    kept in a fixed-size RAM ring of scaled integers, stamped with ticks_ms
+    so they get their wall-clock time from `timesync` when they are sent,
+    even if the clock was not set yet when they were taken.
+
+    When the ring is full the oldest sample goes to a spill file on flash
+    of at most `spill_size` bytes, 0 turns spilling off. ticks_ms starts
+    over at a reboot, so the spill file only lives as long as the boot.
+
+    `drain()` sends the oldest samples first, at most `batch` per call, so
+    live telemetry keeps its share of the connection. """
+
+    def __init__(self, history, timesync, length=480, batch=10, spill_size=0):
+        self.history = history
+        self.timesync = timesync
+        self.length = length
+        self.batch = batch
+        self.spill_size = spill_size
+        columns = len(history.columns)
+        self.times = array('L', [0] * length)  # ticks_ms of each sample
+        self.data = [array('h', [MISSING] * length) for _ in range(columns)]
+        self.head = 0  # Samples recorded
+        self.tail = 0  # Samples sent or spilled
+        self._format = "<L%dh" % columns
+        self._record = bytearray(struct.calcsize(self._format))
+        self._spilled = 0  # Bytes in the spill file
+        self._spill_pos = 0  # Bytes of the spill file already sent
+        try:
+            os.remove(SPILL_FILE)
+        except OSError:
+            pass
+
+    def pending(self):
+        """ Samples waiting to be sent. """
+        return self.head - self.tail + (self._spilled - self._spill_pos) // len(self._record)
+
+    def record(self):
+        if self.head - self.tail == self.length:
+            self._spill(self.tail % self.length)
+            self.tail += 1
+        slot = self.head % self.length
+        self.times[slot] = time.ticks_ms()
+        for i, value in enumerate(self.history.sample()):
+            self.data[i][slot] = value
+        self.head += 1
+
+    def _spill(self, slot):
+        record = self._record
+        if self._spilled + len(record) > self.spill_size:
+            metrics.inc("backfill_dropped")
+            return
+        struct.pack_into(self._format, record, 0, self.times[slot],
+                         *[column[slot] for column in self.data])
+        try:
+            with open(SPILL_FILE, "ab") as f:
+                f.write(record)
+            self._spilled += len(record)
+        except OSError as e:
+            metrics.inc("backfill_dropped")
+            logger.error("Failed to spill sample: %s", e)
+
+    def drain(self, client, topic):
+        """ Publishes the next batch of pending samples. Nothing is taken off
+        the buffer unless the publish went through. """
+        if not self.pending() or not self.timesync.synced:
+            return
+        messages = []
+        spilled = 0
+        if self._spill_pos < self._spilled:
+            record = self._record
+            with open(SPILL_FILE, "rb") as f:
+                f.seek(self._spill_pos)
+                while len(messages) < self.batch and f.readinto(record) == len(record):
+                    values = struct.unpack(self._format, record)
+                    messages.append((topic, self._message(values[0], values[1:])))
+                    spilled += len(record)
+        ring = min(self.batch - len(messages), self.head - self.tail)
+        for n in range(ring):
+            slot = (self.tail + n) % self.length
+            messages.append((topic, self._message(
+                self.times[slot], [column[slot] for column in self.data])))
+        client.publish_many(messages)
+        self.tail += ring
+        self._spill_pos += spilled
+        if self._spilled and self._spill_pos >= self._spilled:
+            os.remove(SPILL_FILE)
+            self._spilled = 0
+            self._spill_pos = 0
+
+    def _message(self, ticks, values):
+        fields = ['"time":%d' % self.timesync.epoch(ticks)]
+        for (name, _, scale), value in zip(self.history.columns, values):
+            if value != MISSING:
+                fields.append('"%s":%s' % (name, value / scale))
+        return "{" + ",".join(fields) + "}"
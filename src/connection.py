@@ -0,0 +1,155 @@
+import time
+import random
+from metrics import metrics
+import log
+
+logger = log.get_logger("connection")
+
+WIFI_TIMEOUT = 20000  # ms for the station to join the network
+MQTT_TIMEOUT = 10000  # ms for the broker to accept the connection
+
+
+class Backoff:
+    """ Exponential backoff with jitter. Every failure doubles the delay up
+    to `maximum`, and the wait is drawn between half of the delay and the
+    full delay, so many substations that lost the same broker do not all
+    come back at once. """
+
+    def __init__(self, initial=1000, maximum=300000):
+        self.initial = initial  # ms
+        self.maximum = maximum  # ms
+        self.delay = 0  # ms, 0 until the first failure
+        self.next = None  # ticks_ms of the next attempt, None for at once
+
+    def fail(self, now):
+        self.delay = min(self.maximum, self.delay * 2 or self.initial)
+        # getrandbits is in every MicroPython port, random() is not
+        half = self.delay // 2
+        self.next = time.ticks_add(now, half + half * random.getrandbits(16) // 65536)
+
+    def reset(self):
+        self.delay = 0
+        self.next = None
+
+    def remaining(self, now):
+        """ ms until the next attempt may start. """
+        if self.next is None:
+            return 0
+        return max(0, time.ticks_diff(self.next, now))
+
+
+class ConnectionManager:
+    """ Keeps the station on the WiFi network and the MQTT client on the
+    broker without blocking the control loop. `run()` takes at most one
+    step per call and should be called often, e.g. every 200 ms: it starts
+    a join or a connect, or checks on the one in progress. Attempts that
+    do not finish before their deadline count as failed, and failures are
+    retried with exponential backoff. MQTT is only tried with WiFi up. """
+
+    def __init__(self, wifi_client, mqtt, ssid, password):
+        self.wifi_client = wifi_client
+        self.mqtt = mqtt
+        self.ssid = ssid
+        self.password = password
+        self.state = ConnectionManager.WIFI_DOWN
+        self.last_error = ""
+        self.wifi_backoff = Backoff(initial=5000)
+        self.mqtt_backoff = Backoff()
+        self._deadline = None  # ticks_ms when the running attempt fails
+
+    def retry_in(self):
+        """ s until the next attempt, 0 while connected or trying. """
+        now = time.ticks_ms()
+        if self.state == ConnectionManager.WIFI_DOWN:
+            return self.wifi_backoff.remaining(now) // 1000
+        if self.state == ConnectionManager.MQTT_DOWN:
+            return self.mqtt_backoff.remaining(now) // 1000
+        return 0
+
+    def run(self):
+        now = time.ticks_ms()
+        state = self.state
+        if state != ConnectionManager.WIFI_DOWN and state != ConnectionManager.WIFI_JOINING:
+            if not self.wifi_client.isconnected():
+                # Rejoin at once, the backoff was reset when WiFi came up
+                metrics.inc("connection_failures")
+                self.last_error = "WiFi lost"
+                logger.warning("WiFi lost")
+                self.mqtt.abort_connect()
+                self._set_state(ConnectionManager.WIFI_DOWN)
+                return
+
+        if state == ConnectionManager.WIFI_DOWN:
+            if self.wifi_backoff.remaining(now):
+                return
+            if self.wifi_client.isconnected():
+                self._set_state(ConnectionManager.MQTT_DOWN)
+                return
+            try:
+                # Returns at once, the driver joins in the background
+                self.wifi_client.connect(self.ssid, self.password)
+            except OSError as e:
+                self._fail("WiFi %s" % e, now, self.wifi_backoff, ConnectionManager.WIFI_DOWN)
+                return
+            self._deadline = time.ticks_add(now, WIFI_TIMEOUT)
+            self._set_state(ConnectionManager.WIFI_JOINING)
+
+        elif state == ConnectionManager.WIFI_JOINING:
+            if self.wifi_client.isconnected():
+                logger.info("Network connected, IP: %s", self.wifi_client.ipconfig('addr4'))
+                self.wifi_backoff.reset()
+                self._set_state(ConnectionManager.MQTT_DOWN)
+            elif time.ticks_diff(now, self._deadline) >= 0:
+                try:
+                    self.wifi_client.disconnect()  # Stop the join before the next one
+                except OSError:
+                    pass
+                self._fail("WiFi timeout", now, self.wifi_backoff, ConnectionManager.WIFI_DOWN)
+
+        elif state == ConnectionManager.MQTT_DOWN:
+            if self.mqtt_backoff.remaining(now):
+                return
+            try:
+                self.mqtt.begin_connect()
+            except Exception as e:
+                self._fail("MQTT %r" % e, now, self.mqtt_backoff, ConnectionManager.MQTT_DOWN)
+                return
+            self._deadline = time.ticks_add(now, MQTT_TIMEOUT)
+            self._set_state(ConnectionManager.MQTT_CONNECTING)
+
+        elif state == ConnectionManager.MQTT_CONNECTING:
+            try:
+                done = self.mqtt.poll_connect()
+            except Exception as e:
+                self.mqtt.abort_connect()
+                self._fail("MQTT %r" % e, now, self.mqtt_backoff, ConnectionManager.MQTT_DOWN)
+                return
+            if done:
+                self.mqtt_backoff.reset()
+                self.last_error = ""
+                self._set_state(ConnectionManager.CONNECTED)
+            elif time.ticks_diff(now, self._deadline) >= 0:
+                self.mqtt.abort_connect()
+                self._fail("MQTT timeout", now, self.mqtt_backoff, ConnectionManager.MQTT_DOWN)
+
+        elif not self.mqtt.connected:
+            # MQTTController dropped the connection after an error
+            self._fail("MQTT lost", now, self.mqtt_backoff, ConnectionManager.MQTT_DOWN)
+
+    def _fail(self, error, now, backoff, state):
+        metrics.inc("connection_failures")
+        backoff.fail(now)
+        self.last_error = error
+        logger.warning("%s, next attempt in %d s", error, backoff.remaining(now) // 1000)
+        self._set_state(state)
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.debug("Connection %s -> %s", self.state, state)
+            self.state = state
+
+ConnectionManager.WIFI_DOWN = "wifi_down"
+ConnectionManager.WIFI_JOINING = "wifi_joining"
+ConnectionManager.MQTT_DOWN = "mqtt_down"
+ConnectionManager.MQTT_CONNECTING = "mqtt_connecting"
+ConnectionManager.CONNECTED = "connected"
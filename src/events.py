@@ -0,0 +1,34 @@
+import log
+
+logger = log.get_logger("events")
+
+# Event kinds, bit flags so a subscriber can filter on several at once
+VALVE = 0x01  # valve_position, valve_adjusting
+PUMP = 0x02  # pump_status, pump_power
+REGULATOR = 0x04  # regulator_mode, parameters and regulation_adjustment
+SENSOR = 0x08  # A reading or the stale flag of the named sensor changed
+ALL = 0xff
+
+
+class EventBus:
+    """ Synchronous publish/subscribe for state changes. An event is the
+    kind, the name of what changed and its new value, passed straight to
+    the subscribers as arguments, so emitting allocates nothing. Names are
+    the same as the MQTT topics and status fields. """
+
+    def __init__(self):
+        self._subscribers = []  # (mask, callback)
+
+    def subscribe(self, callback, mask=ALL):
+        """ `callback(kind, name, value)` is called for every event whose
+        kind is in `mask`. """
+        self._subscribers.append((mask, callback))
+
+    def emit(self, kind, name, value):
+        for mask, callback in self._subscribers:
+            if mask & kind:
+                try:
+                    callback(kind, name, value)
+                except Exception as e:
+                    # A broken consumer must not stop the component that emitted
+                    logger.error("Error handling %s event: %s", name, e)
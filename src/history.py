@@ -0,0 +1,107 @@
+import time
+import struct
+from array import array
+
+MISSING = -32768  # Stored for values that were not available
+
+HEADER_MAGIC = b"HIST"
+HEADER_VERSION = 1
+
+
+class History:
+    """ In-RAM ring of periodic samples. Every column is a preallocated
+    array('h') of scaled integers, e.g. centi-degrees, so the memory cost is
+    fixed at 2 bytes per column and sample plus 4 bytes for the time.
+
+    Samples are stamped with ticks_ms and get their Unix time from
+    `timesync` when they are read, as in Backfill, so samples taken before
+    the clock was set are placed right once it is. """
+
+    def __init__(self, timesync, length=1440):
+        self.timesync = timesync
+        self.length = length
+        self.columns = []  # (name, getter, scale)
+        self.data = []
+        self.times = array('L', [0] * length)  # ticks_ms of each sample
+        self.count = 0  # Samples recorded since start
+
+    def add_column(self, name, getter, scale=100):
+        self.columns.append((name, getter, scale))
+        self.data.append(array('h', [MISSING] * self.length))
+
+    def sample(self):
+        """ Current value of every column as a scaled integer. """
+        values = []
+        for name, getter, scale in self.columns:
+            try:
+                value = getter()
+            except Exception:
+                value = None
+            if value is None:
+                values.append(MISSING)
+            else:
+                values.append(max(-32767, min(32767, int(round(value * scale)))))
+        return values
+
+    def record(self):
+        slot = self.count % self.length
+        self.times[slot] = time.ticks_ms()
+        for i, value in enumerate(self.sample()):
+            self.data[i][slot] = value
+        self.count += 1
+
+    def rows(self, start=None, end=None, step=0):
+        """ Yields (time, values) for the samples between `start` and `end`
+        (Unix seconds, inclusive). With `step` > 0 the samples in every
+        `step` seconds bucket are averaged into one row. Values are the
+        stored scaled integers, MISSING where nothing was recorded. Nothing
+        is yielded before the first time sync. """
+        if not self.timesync.synced:
+            return
+        columns = len(self.columns)
+        bucket = None
+        sums = [0] * columns
+        counts = [0] * columns
+        for s in range(max(0, self.count - self.length), self.count):
+            slot = s % self.length
+            t = self.timesync.epoch(self.times[slot])
+            if (start is not None and t < start) or (end is not None and t > end):
+                continue
+            if step <= 0:
+                yield t, [column[slot] for column in self.data]
+                continue
+            b = t - t % step
+            if bucket is not None and b != bucket:
+                yield bucket, _averages(sums, counts)
+                for i in range(columns):
+                    sums[i] = 0
+                    counts[i] = 0
+            bucket = b
+            for i in range(columns):
+                value = self.data[i][slot]
+                if value != MISSING:
+                    sums[i] += value
+                    counts[i] += 1
+        if step > 0 and bucket is not None:
+            yield bucket, _averages(sums, counts)
+
+    def binary_header(self):
+        """ Magic, version and column count, then per column its name
+        (length prefixed) and scale. Rows follow as <L time and <h values. """
+        header = bytearray(struct.pack("<4sBB", HEADER_MAGIC, HEADER_VERSION, len(self.columns)))
+        for name, _, scale in self.columns:
+            header += struct.pack("<B", len(name)) + name.encode() + struct.pack("<h", scale)
+        return header
+
+    def csv_header(self):
+        return "time," + ",".join(name for name, _, _ in self.columns) + "\n"
+
+    def csv_row(self, t, values):
+        fields = [str(t)]
+        for (name, _, scale), value in zip(self.columns, values):
+            fields.append("" if value == MISSING else str(value / scale))
+        return ",".join(fields) + "\n"
+
+
+def _averages(sums, counts):
+    return [int(round(sums[i] / counts[i])) if counts[i] else MISSING for i in range(len(sums))]
@@ -1,8 +1,24 @@
-import socket
-import _thread
 import time
 import json
+import struct
+import binascii
 from regulator import Regulator
+from autotune import Autotune
+from scheduler import asyncio, sleep_ms
+from metrics import metrics
+import log
+
+logger = log.get_logger("http")
+
+# Precompressed dashboard, regenerate with `gzip -9 -n -k -f www/index.html`
+UI_PATH = "www/index.html.gz"
+CHUNK_SIZE = 512
+
+MAX_EVENT_CLIENTS = 4
+EVENT_POLL_INTERVAL = 200  # ms between checks for a new snapshot to push
+EVENT_SEND_TIMEOUT = 2  # s before a stuck /events client is dropped
+REQUEST_TIMEOUT = 5  # s to wait for a request after accepting a client
+STATUS_REFRESH = 10000  # ms, rebuild without events for the uptime and connection state
 
 def format_uptime(seconds):
     SECS_PER_MIN = 60
@@ -18,238 +34,344 @@ def format_uptime(seconds):
 
     return f"{days:.0f}d {hours:.0f}h {minutes:.0f}m {seconds:.0f}s"
 
+def query_param(request, name, default=None):
+    """ Value of `name` in the query string of the request line. """
+    path = request.split(" ", 2)[1] if request.count(" ") >= 2 else ""
+    _, _, query = path.partition("?")
+    for pair in query.split("&"):
+        key, _, value = pair.partition("=")
+        if key == name:
+            return value
+    return default
+
+def int_param(request, name, default=None):
+    """ `name` as an integer, `default` when it is missing. Raises
+    ValueError when it is malformed. """
+    value = query_param(request, name)
+    return default if value is None else int(value)
+
 class HTTPView:
-    def __init__(self, wifi_client, access_point, mqtt, system, port, reset_function):
+    def __init__(self, wifi_client, access_point, mqtt, connections, system, port, reset_function,
+                 history=None, archive=None, timesync=None, backfill=None):
         self._sensors = []
         self._sta_if = wifi_client
         self._ap = access_point
         self.system = system
         self.mqtt = mqtt
+        self.connections = connections
         self.port = port
         self.reset_function = reset_function
+        self.history = history
+        self.archive = archive
+        self.timesync = timesync
+        self.backfill = backfill
+        self._chunk = bytearray(CHUNK_SIZE)
+        self._ui_etag = None
+        self._ui_size = 0
+        self._status = None
+        self._status_time = None  # ticks_ms of the last snapshot
+        self._changed = True  # A change event arrived since the last snapshot
+        self._connection_state = None  # ConnectionManager state in the last snapshot
+        self._pushed_status = None
+        self._event_clients = []
+        system.events.subscribe(self._on_event)
 
-    def start(self):
-        _thread.start_new_thread(self._serve, ())
+    async def serve(self):
+        """ Serves HTTP on the event loop and pushes new status snapshots to
+        /events clients. Runs forever. """
+        await asyncio.start_server(self._client, '0.0.0.0', self.port)
+        while True:
+            await self._push_events()
+            await sleep_ms(EVENT_POLL_INTERVAL)
 
     def add_sensor(self, sensor):
         self._sensors.append(sensor)
 
-    def _serve(self):
+    def _control(self, request):
+        regulator = self.system.regulator
+        if 'GET /pump?state=on' in request:
+            self.system.pump.start()
+        elif 'GET /pump?state=off' in request:
+            self.system.pump.stop()
+        elif 'GET /valve?state=open' in request:
+            self.system.valve.open()
+        elif 'GET /valve?state=close' in request:
+            self.system.valve.close()
+        elif 'GET /valve?state=calibrate' in request:
+            self.system.valve.calibrate()
+        elif 'GET /autotune?' in request and query_param(request, "state") in Autotune.ACTIONS:
+            getattr(self.system.autotune, query_param(request, "state"))()
+        elif 'GET /regulator?state=auto' in request:
+            regulator.set_mode(Regulator.AUTOMATIC)
+        elif 'GET /regulator?state=manual' in request:
+            regulator.set_mode(Regulator.MANUAL)
+        elif 'GET /reset' in request:
+            self.reset_function()
+        elif 'GET /set_curve_gain?state=increase' in request:
+            regulator.set_gain(regulator.gain + 0.1)
+        elif 'GET /set_curve_gain?state=decrease' in request:
+            regulator.set_gain(regulator.gain - 0.1)
+        elif 'GET /set_base_temp?state=increase' in request:
+            regulator.set_offset(regulator.offset + 1)
+        elif 'GET /set_base_temp?state=decrease' in request:
+            regulator.set_offset(regulator.offset - 1)
+        elif 'GET /set_proportional_gain?state=increase' in request:
+            regulator.set_proportional_gain(regulator.proportional_gain + 0.1)
+        elif 'GET /set_proportional_gain?state=decrease' in request:
+            regulator.set_proportional_gain(regulator.proportional_gain - 0.1)
+        elif 'GET /set_algorithm?' in request and query_param(request, "state") in Regulator.ALGORITHMS:
+            regulator.set_algorithm(query_param(request, "state"))
+        elif 'GET /set_integral_time?state=increase' in request:
+            regulator.set_integral_time(regulator.integral_time + 60)
+        elif 'GET /set_integral_time?state=decrease' in request:
+            regulator.set_integral_time(regulator.integral_time - 60)
+        elif 'GET /set_derivative_time?state=increase' in request:
+            regulator.set_derivative_time(regulator.derivative_time + 10)
+        elif 'GET /set_derivative_time?state=decrease' in request:
+            regulator.set_derivative_time(regulator.derivative_time - 10)
+        elif 'GET /set_feed_forward_gain?state=increase' in request:
+            regulator.set_feed_forward_gain(regulator.feed_forward_gain + 0.1)
+        elif 'GET /set_feed_forward_gain?state=decrease' in request:
+            regulator.set_feed_forward_gain(regulator.feed_forward_gain - 0.1)
+        else:
+            return False
+        return True
+
+    def _load_ui(self):
+        # The ETag is a CRC of the compressed page, so it only changes
+        # when a new page is uploaded.
+        crc = 0
+        size = 0
+        with open(UI_PATH, "rb") as f:
+            while True:
+                n = f.readinto(self._chunk)
+                if not n:
+                    break
+                crc = binascii.crc32(memoryview(self._chunk)[:n], crc)
+                size += n
+        self._ui_size = size
+        self._ui_etag = '"%08x"' % (crc & 0xffffffff)
+
+    async def _send_ui(self, writer, request):
+        if self._ui_etag is None:
+            self._load_ui()
+        if self._ui_etag in request:  # If-None-Match
+            writer.write(b'HTTP/1.0 304 Not Modified\r\n\r\n')
+            return
+        writer.write(('HTTP/1.0 200 OK\r\nContent-Type: text/html\r\n'
+                      'Content-Encoding: gzip\r\nCache-Control: no-cache\r\n'
+                      f'ETag: {self._ui_etag}\r\nContent-Length: {self._ui_size}\r\n\r\n').encode())
+        with open(UI_PATH, "rb") as f:
+            while True:
+                n = f.readinto(self._chunk)
+                if not n:
+                    break
+                writer.write(memoryview(self._chunk)[:n])
+                await writer.drain()
+
+    def _on_event(self, kind, name, value):
+        self._changed = True
+
+    def publish_status(self):
+        """ Called once per main loop tick. Serializes the system state once
+        something changed, /status and /events then only hand out the cached
+        bytes. """
+        now = time.ticks_ms()
+        connection = self.connections.state  # Not on the event bus
+        if (not self._changed and self._status_time is not None
+                and connection == self._connection_state
+                and time.ticks_diff(now, self._status_time) < STATUS_REFRESH):
+            return
+        self._changed = False
+        self._connection_state = connection
+        self._status_time = now
         try:
-            addr = socket.getaddrinfo('0.0.0.0', self.port)[0][-1]
-            s = socket.socket()
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind(addr)
-            s.listen(1)
+            # Replaced as a whole, so the HTTP thread never sees a partial snapshot
+            self._status = json.dumps(self._build_status()).encode('utf-8')
         except Exception as e:
-            print("Could not start webserver: " + str(e))
-            return
-        while True:
+            logger.error("Error building status: %s", e)
+
+    def _build_status(self):
+        sensors_data = []
+        for sensor in self._sensors:
             try:
-                cl, addr = s.accept()
-                request = cl.recv(1024).decode()
-
-                # Handle AJAX status request
-                if "GET /status" in request:
-                    try:
-                        # Safely get sensor data
-                        sensors_data = []
-                        for sensor in self._sensors:
-                            try:
-                                sensor_info = {"name": sensor.name(), "value": sensor.value() or 0}
-                                sensors_data.append(sensor_info)
-                            except Exception as e:
-                                print(f"Error reading sensor: {e}")
-                                sensors_data.append({"name": "unknown", "value": 0})
-                        status = {
-                            "uptime": format_uptime(int(time.ticks_ms() / 1000)),
-                            "sta_if": self._sta_if.isconnected(),
-                            "ap": self._ap.active(),
-                            "regulator_mode": getattr(self.system.regulator, 'mode', 'unknown'),
-                            "pump": self.system.pump.status,  # Send the actual status string
-                            "valve_adjusting": getattr(self.system.valve, 'adjusting', 0),
-                            "valve_opening": getattr(self.system.valve, 'opening', False),
-                            "valve_closing": getattr(self.system.valve, 'closing', False),
-                            "valve_position": getattr(self.system.valve, 'position', 0),
-                            "mqtt": getattr(self.mqtt, 'connected', False),
-                            "regulation_adjustment": getattr(self.system.regulator, 'regulation_adjustment', 0),
-                            "desired_temp": getattr(self.system.regulator, 'desired_secondary_supply_temp', lambda: 0)(),
-                            "sensors": sensors_data,
-                            "gain": getattr(self.system.regulator, 'gain', 0),
-                            "offset": getattr(self.system.regulator, 'offset', 0),
-                            "proportional_gain": getattr(self.system.regulator, 'proportional_gain', 0),
-                        }
-                        content = json.dumps(status)
-                        cl.send(b'HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n\r\n')
-                        cl.send(content.encode('utf-8'))
-                        cl.close()
-                        continue
-                    except Exception as e:
-                        print(f"Error in status endpoint: {e}")
-                        cl.send(b'HTTP/1.0 500 Internal Server Error\r\n\r\n')
-                        cl.close()
-                        continue
-                    continue
-
-                # Parse control requests
-                if 'GET /pump?state=on' in request:
-                    self.system.pump.start()
-                elif 'GET /pump?state=off' in request:
-                    self.system.pump.stop()
-                elif 'GET /valve?state=open' in request:
-                    self.system.valve.open()
-                elif 'GET /valve?state=close' in request:
-                    self.system.valve.close()
-                elif 'GET /regulator?state=auto' in request:
-                    self.system.regulator.set_mode(Regulator.AUTOMATIC)
-                elif 'GET /regulator?state=manual' in request:
-                    self.system.regulator.set_mode(Regulator.MANUAL)
-                elif 'GET /reset' in request:
-                    self.reset_function()
-                elif 'GET /set_curve_gain?state=increase' in request:
-                    self.system.regulator.gain += 0.1
-                elif 'GET /set_curve_gain?state=decrease' in request:
-                    self.system.regulator.gain -= 0.1
-                elif 'GET /set_base_temp?state=increase' in request:
-                    self.system.regulator.offset += 1
-                elif 'GET /set_base_temp?state=decrease' in request:
-                    self.system.regulator.offset -= 1
-                elif 'GET /set_proportional_gain?state=increase' in request:
-                    self.system.regulator.proportional_gain += 0.1
-                elif 'GET /set_proportional_gain?state=decrease' in request:
-                    self.system.regulator.proportional_gain -= 0.1
-                html = """<!DOCTYPE html>
-<html>
-<head>
-<title>Heating Control</title>
-<meta name="viewport" content="width=device-width,initial-scale=1">
-<style>
-body{font-family:Arial;margin:0;background:#f5f5f5}
-.container{max-width:800px;margin:10px auto;padding:10px}
-.card{background:#fff;border-radius:8px;padding:15px;margin:10px 0;box-shadow:0 2px 5px rgba(0,0,0,0.1)}
-h1,h2{margin:0 0 10px 0;color:#333}
-.grid{display:grid;grid-template-columns:1fr 1fr;gap:10px}
-.item{background:#f8f9fa;padding:10px;border-radius:5px;border-left:3px solid #ddd}
-.online{border-left-color:#4caf50}
-.offline{border-left-color:#f44336}
-.warning{border-left-color:#ff9800}
-.label{font-size:12px;color:#666;margin-bottom:3px}
-.value{font-weight:bold}
-button{padding:5px 10px;border:none;border-radius:3px;margin:2px;cursor:pointer;font-size:12px}
-.on{background:#4caf50;color:white}
-.off{background:#f44336;color:white}
-.auto{background:#9c27b0;color:white}
-.manual{background:#607d8b;color:white}
-.open{background:#2196f3;color:white}
-.close{background:#ff9800;color:white}
-.reset{background:#e91e63;color:white}
-.sensors{display:grid;grid-template-columns:repeat(auto-fit,minmax(120px,1fr));gap:10px}
-.sensor{background:#667eea;color:white;padding:15px;border-radius:5px;text-align:center}
-.temp{font-size:18px;font-weight:bold}
-.valve-bar{width:100%;height:15px;background:#eee;border-radius:7px;overflow:hidden;margin:5px 0}
-.valve-fill{height:100%;background:#4caf50;transition:width 0.3s}
-@media(max-width:600px){.grid{grid-template-columns:1fr}.sensors{grid-template-columns:1fr 1fr}}
-</style>
-</head>
-<body>
-<div class="container">
-<h1>Heating Control</h1>
-
-<div class="card">
-<h2>System</h2>
-<div class="grid">
-<div class="item"><div class="label">Uptime</div><div class="value" id="uptime">...</div>
-<button class="reset" onclick="sendAction('reset')">RESTART</button></div>
-<div class="item" id="net"><div class="label">Network</div><div class="value" id="network">...</div></div>
-<div class="item" id="reg"><div class="label">Mode</div><div class="value" id="mode">...</div>
-<button class="auto" onclick="sendAction('regulator','auto')">AUTO</button>
-<button class="manual" onclick="sendAction('regulator','manual')">MANUAL</button></div>
-<div class="item" id="mqtt"><div class="label">MQTT</div><div class="value" id="mqttstat">...</div></div>
-</div>
-</div>
-
-<div class="card">
-<h2>Equipment</h2>
-<div class="grid">
-<div class="item" id="pump"><div class="label">Pump</div><div class="value" id="pumpstat">...</div>
-<button class="on" onclick="sendAction('pump','on')">START</button>
-<button class="off" onclick="sendAction('pump','off')">STOP</button></div>
-<div class="item" id="valve"><div class="label">Valve</div><div class="value" id="valvestat">...</div>
-<div>Position: <span id="pos">0</span>/150</div>
-<div class="valve-bar"><div class="valve-fill" id="fill"></div></div>
-<button class="open" onclick="sendAction('valve','open')">OPEN</button>
-<button class="close" onclick="sendAction('valve','close')">CLOSE</button></div>
-</div>
-</div>
-
-<div class="card">
-<h2>Regulation</h2>
-<div class="grid">
-<div class="item"><div class="label">Desired House Supply Temp</div><div class="value" id="desired_temp">...</div></div>
-<div class="item"><div class="label">Regulation Adjustment</div><div class="value" id="regulation_adj">...</div></div>
-<div class="item"><div class="label">Curve Gain</div><div class="value" id="curve_gain">...</div>
-<button class="+0.1" onclick="sendAction('set_curve_gain','increase')">+0.1</button>
-<button class="-0.1" onclick="sendAction('set_curve_gain','decrease')">-0.1</button></div>
-<div class="item"><div class="label">Base Temperature</div><div class="value" id="base_temp">...</div>
-<button class="+1" onclick="sendAction('set_base_temp','increase')">+1&deg;C</button>
-<button class="-1" onclick="sendAction('set_base_temp','decrease')">-1&deg;C</button></div>
-<div class="item"><div class="label">Proportional Gain</div><div class="value" id="proportional_gain">...</div>
-<button class="+0.1" onclick="sendAction('set_proportional_gain','increase')">+0.1</button>
-<button class="-0.1" onclick="sendAction('set_proportional_gain','decrease')">-0.1</button></div>
-</div>
-</div>
-
-<div class="card">
-<h2>Sensors</h2>
-<div class="sensors" id="sensors"></div>
-</div>
-
-</div>
-<script>
-function sendAction(d,s){fetch('/'+d+'?state='+s).then(()=>setTimeout(update,500))}
-function update(){
-fetch('/status').then(r=>r.json()).then(d=>{
-document.getElementById('uptime').textContent=d.uptime;
-document.getElementById('network').innerHTML=(d.sta_if?'WiFi OK':'WiFi OFF')+'<br>'+(d.ap?'AP ON':'AP OFF');
-document.getElementById('mode').textContent=d.regulator_mode.toUpperCase();
-document.getElementById('reg').className=d.regulator_mode==='automatic'?'item online':'item warning';
-document.getElementById('mqttstat').textContent=d.mqtt?'Connected':'Disconnected';
-document.getElementById('mqtt').className=d.mqtt?'item online':'item offline';
-document.getElementById('pumpstat').textContent=d.pump==='on'?'RUNNING':d.pump==='off'?'STOPPED':'UNKNOWN';
-document.getElementById('pump').className=d.pump==='on'?'item online':d.pump==='off'?'item offline':'item warning';
-let vs='IDLE';
-if(d.valve_adjusting>0){
-vs=d.valve_opening?'OPENING ('+d.valve_adjusting+'s)':'CLOSING ('+d.valve_adjusting+'s)';
-document.getElementById('valve').className='item warning';
-}else{document.getElementById('valve').className='item online'}
-document.getElementById('valvestat').textContent=vs;
-document.getElementById('pos').textContent=d.valve_position||0;
-document.getElementById('fill').style.width=((d.valve_position||0)/150*100)+'%';
-document.getElementById('desired_temp').innerHTML=(d.desired_temp||0).toFixed(1)+'&deg;C';
-document.getElementById('regulation_adj').textContent=(d.regulation_adjustment||0).toFixed(2);
-document.getElementById('curve_gain').innerHTML=(d.gain||0).toFixed(2);
-document.getElementById('base_temp').innerHTML=(d.offset||0).toFixed(1)+'&deg;C';
-document.getElementById('proportional_gain').innerHTML=(d.proportional_gain||0).toFixed(2);
-let sh='';
-const sensorNames={
-'ambient_temp':'Outdoor Air',
-'primary_supply_temp':'Heat Source In',
-'primary_return_temp':'Heat Source Out',
-'secondary_supply_temp':'Building Supply',
-'secondary_return_temp':'Building Return'
-};
-for(let s of d.sensors){
-let n=sensorNames[s.name]||s.name.replace(/_/g,' ').replace(/temp/g,'').trim();
-sh+='<div class="sensor"><div>'+n+'</div><div class="temp">'+s.value.toFixed(1)+'&deg;C</div></div>';
-}
-document.getElementById('sensors').innerHTML=sh;
-}).catch(e=>console.error(e))}
-setInterval(update,2000);update();
-</script>
-</body>
-</html>"""
-                cl.send(b'HTTP/1.0 200 OK\r\nContent-type: text/html\r\n\r\n')
-                cl.send(html.encode('utf-8'))
-                cl.close()
+                sensor_info = {"name": sensor.name(), "value": sensor.value() or 0,
+                               "stale": sensor.is_stale()}
+                sensors_data.append(sensor_info)
             except Exception as e:
-                print("HTTP Error:", e)
+                logger.error("Error reading sensor: %s", e)
+                sensors_data.append({"name": "unknown", "value": 0})
+        regulator = self.system.regulator
+        valve = self.system.valve
+        autotune = self.system.autotune
+        return {
+            "uptime": format_uptime(int(time.ticks_ms() / 1000)),
+            "sta_if": self._sta_if.isconnected(),
+            "ap": self._ap.active(),
+            "regulator_mode": regulator.mode,
+            "pump": self.system.pump.status,  # Send the actual status string
+            "valve_adjusting": valve.adjusting,
+            "valve_opening": valve.opening,
+            "valve_closing": valve.closing,
+            "valve_position": valve.position,
+            "valve_last_pulse_ms": valve.last_on_time,
+            "valve_position_error": valve.position_error,
+            "valve_stroke_time": valve.stroke_time,
+            "valve_calibrating": valve.calibration is not None,
+            "mqtt": self.mqtt.connected,
+            "mqtt_inflight": self.mqtt.client.inflight(),
+            "connection": self.connections.state,
+            "connection_error": self.connections.last_error,
+            "connection_retry": self.connections.retry_in(),
+            "time_synced": self.timesync is not None and self.timesync.synced,
+            "backfill_pending": self.backfill.pending() if self.backfill is not None else 0,
+            "regulation_adjustment": regulator.regulation_adjustment,
+            "desired_temp": regulator.desired_secondary_supply_temp(),
+            "sensors": sensors_data,
+            "gain": regulator.gain,
+            "offset": regulator.offset,
+            "proportional_gain": regulator.proportional_gain,
+            "algorithm": regulator.algorithm,
+            "integral_time": regulator.integral_time,
+            "derivative_time": regulator.derivative_time,
+            "feed_forward_gain": regulator.feed_forward_gain,
+            "adjustment_interval": regulator.adjustment_interval,
+            "adjustment_threshold": regulator.adjustment_threshold,
+            "autotune": autotune.state,
+            "autotune_reason": autotune.reason,
+            "autotune_process_gain": autotune.process_gain,
+            "autotune_dead_time": autotune.dead_time,
+            "autotune_time_constant": autotune.time_constant,
+            "autotune_recommendation": autotune.recommendation,
+        }
+
+    async def _send_history(self, writer, request):
+        """ /history?from=&to=&step=&format=csv|bin, times in Unix seconds
+        and step in seconds for server side averaging. """
+        history = self.history
+        try:
+            start = int_param(request, "from")
+            end = int_param(request, "to")
+            step = int_param(request, "step", 0)
+        except ValueError:
+            writer.write(b'HTTP/1.0 400 Bad Request\r\n\r\n')
+            return
+        rows = history.rows(start, end, step)
+        if query_param(request, "format", "csv") == "bin":
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: application/octet-stream\r\n\r\n')
+            writer.write(history.binary_header())
+            row_format = "<L%dh" % len(history.columns)
+            row = bytearray(struct.calcsize(row_format))
+            for t, values in rows:
+                struct.pack_into(row_format, row, 0, t, *values)
+                writer.write(row)
+                await writer.drain()
+        else:
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/csv\r\n\r\n')
+            writer.write(history.csv_header().encode())
+            for t, values in rows:
+                writer.write(history.csv_row(t, values).encode())
+                await writer.drain()
+
+    async def _send_archive(self, writer, request):
+        """ /archive?from=&to= as CSV, streamed block by block from flash. """
+        try:
+            start = int_param(request, "from")
+            end = int_param(request, "to")
+        except ValueError:
+            writer.write(b'HTTP/1.0 400 Bad Request\r\n\r\n')
+            return
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/csv\r\n\r\n')
+        writer.write(self.history.csv_header().encode())
+        for t, values in self.archive.rows(start, end):
+            writer.write(self.history.csv_row(t, values).encode())
+            await writer.drain()
+
+    async def _push_events(self):
+        status = self._status
+        if status is None or status is self._pushed_status:
+            return
+        self._pushed_status = status
+        for writer in list(self._event_clients):
+            try:
+                writer.write(b'data: ')
+                writer.write(status)
+                writer.write(b'\n\n')
+                await asyncio.wait_for(writer.drain(), EVENT_SEND_TIMEOUT)
+            except Exception:
+                self._event_clients.remove(writer)
+                await self._close(writer)
+
+    def _add_event_client(self, writer):
+        if len(self._event_clients) >= MAX_EVENT_CLIENTS:
+            writer.write(b'HTTP/1.0 503 Service Unavailable\r\n\r\n')
+            return False
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\n\r\n')
+        self._event_clients.append(writer)
+        # Force the current snapshot out to the new client
+        self._pushed_status = None
+        return True
+
+    async def _close(self, writer):
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+    async def _client(self, reader, writer):
+        metrics.inc("http_requests")
+        try:
+            request = (await asyncio.wait_for(reader.read(1024), REQUEST_TIMEOUT)).decode()
+            if "GET /events" in request:
+                if self._add_event_client(writer):
+                    await writer.drain()
+                    return
+            else:
+                await self._handle(writer, request)
+            await writer.drain()
+        except Exception as e:
+            logger.warning("HTTP Error: %s", e)
+        await self._close(writer)
+
+    async def _handle(self, writer, request):
+        if "GET /status" in request:
+            status = self._status
+            if status is None:
+                writer.write(b'HTTP/1.0 503 Service Unavailable\r\n\r\n')
+            else:
+                writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n\r\n')
+                writer.write(status)
+        elif "GET /metrics" in request:
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n\r\n')
+            for line in metrics.render():
+                writer.write(line.encode())
+        elif "GET /history" in request and self.history is not None:
+            await self._send_history(writer, request)
+        elif "GET /archive" in request and self.archive is not None:
+            await self._send_archive(writer, request)
+        elif "GET /log/level" in request:
+            level = log.LEVELS.get(query_param(request, "level"))
+            if level is None:
+                writer.write(b'HTTP/1.0 400 Bad Request\r\n\r\n')
+            else:
+                log.ring.set_level(level, query_param(request, "module"))
+                writer.write(b'HTTP/1.0 204 No Content\r\n\r\n')
+        elif "GET /log" in request:
+            try:
+                since = int_param(request, "since", 0)
+            except ValueError:
+                writer.write(b'HTTP/1.0 400 Bad Request\r\n\r\n')
+                return
+            writer.write(('HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n'
+                          f'X-Log-Next: {log.ring.seq}\r\n\r\n').encode())
+            for line in log.ring.since(since):
+                writer.write(line.encode())
+                await writer.drain()
+        elif self._control(request):
+            writer.write(b'HTTP/1.0 204 No Content\r\n\r\n')
+        elif request.startswith("GET / ") or request.startswith("GET /index.html "):
+            await self._send_ui(writer, request)
+        else:
+            writer.write(b'HTTP/1.0 404 Not Found\r\n\r\n')
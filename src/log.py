@@ -0,0 +1,84 @@
+import time
+from array import array
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+
+class RingLog:
+    """ Keeps the last `size` log records in preallocated slots. Every record
+    gets a sequence number so readers can ask for what they have not seen. """
+
+    def __init__(self, size=128, level=INFO):
+        self.size = size
+        self.level = level
+        self.module_levels = {}
+        self.echo = False  # Also print records, for a serial console or the simulator
+        self.seq = 0  # Sequence number of the next record
+        self._times = array('L', [0] * size)
+        self._levels = bytearray(size)
+        self._modules = [None] * size
+        self._messages = [None] * size
+
+    def set_level(self, level, module=None):
+        if module is None:
+            self.level = level
+        else:
+            self.module_levels[module] = level
+
+    def enabled(self, level, module):
+        return level >= self.module_levels.get(module, self.level)
+
+    def write(self, level, module, message):
+        slot = self.seq % self.size
+        self._times[slot] = time.ticks_ms()
+        self._levels[slot] = level
+        self._modules[slot] = module
+        self._messages[slot] = message
+        self.seq += 1
+        if self.echo:
+            print(f"{LEVEL_NAMES[level]} {module}: {message}")
+
+    def since(self, seq):
+        """ Yields the records from sequence number `seq` that are still
+        in the buffer as text lines. """
+        for s in range(max(seq, self.seq - self.size, 0), self.seq):
+            slot = s % self.size
+            yield (f"{s} {self._times[slot]} {LEVEL_NAMES[self._levels[slot]]} "
+                   f"{self._modules[slot]}: {self._messages[slot]}\n")
+
+
+class Logger:
+    def __init__(self, ring, module):
+        self.ring = ring
+        self.module = module
+
+    # Arguments are only formatted into the message when the level is
+    # enabled, so disabled calls in the hot loop stay cheap.
+    def log(self, level, message, *args):
+        if self.ring.enabled(level, self.module):
+            self.ring.write(level, self.module, message % args if args else message)
+
+    def debug(self, message, *args):
+        self.log(DEBUG, message, *args)
+
+    def info(self, message, *args):
+        self.log(INFO, message, *args)
+
+    def warning(self, message, *args):
+        self.log(WARNING, message, *args)
+
+    def error(self, message, *args):
+        self.log(ERROR, message, *args)
+
+
+ring = RingLog()
+
+
+def get_logger(module):
+    return Logger(ring, module)
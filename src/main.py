@@ -1,84 +1,101 @@
 """ Main program """
 
 import json
-import time
 import gc
+import time
 import network
-from machine import Pin
+from machine import Pin, Timer
 from temp_sensor import TempSensors
 from mqtt_controller import MQTTController
+from connection import ConnectionManager
+from timesync import TimeSync
+from backfill import Backfill
 from http_view import HTTPView
 from valve import Valve
 from led import Led
 from regulator import Regulator
 from pump import Pump
+from shelly_client import ShellyClient
 from persistent_state import PersistentState
 import machine
 from system_controller import SystemController
+from events import VALVE, PUMP, REGULATOR
+from scheduler import asyncio, PeriodicTask
+from metrics import metrics
+from history import History
+from archive import Archive
+import log
 
 
 with open("settings.json") as f:
     settings = json.load(f)
 
+logger = log.get_logger("main")
+log_settings = settings.get("log", {})
+log.ring.set_level(log.LEVELS[log_settings.get("level", "info")])
+log.ring.echo = log_settings.get("echo", False)
+
 persistent_state = PersistentState()
 persistent_state.load()
 
-print("Set up LEDs")
+logger.info("Set up LEDs")
 main_led = Led(13)
 pump_led = Led(14)
 valve_led = Led(15)
 mqtt_led = Led(16)
 
-print("Set up wifi client")
+logger.info("Set up wifi client")
 wifi_client = network.WLAN(network.WLAN.IF_STA)
 wifi_client.active(True)
-print(f"Network active: {wifi_client.active()}")
-
-def ensure_connections():
-    try:
-        if not wifi_client.isconnected():
-            wifi_client.connect(settings["station"]["ssid"], settings["station"]["password"])
-            print(f"Network connected {wifi_client.isconnected()}")
-            print(f"IP: {wifi_client.ipconfig('addr4')}")
-        if wifi_client.isconnected() and not mqtt.connected:
-            mqtt.connect()
-    except Exception:
-        pass # Ignore exceptions during reconnect attempts
+logger.info("Network active: %s", wifi_client.active())
 
 # Set up network
-print("Set up Access point")
+logger.info("Set up Access point")
 access_point = network.WLAN(network.AP_IF)
 access_point.active(False) # Reset if active
 access_point.active(True)
 access_point.config(essid=settings["access_point"]["ssid"],
           password=settings["access_point"]["password"],
           authmode=network.AUTH_WPA_WPA2_PSK)
-print('Access Point Active: ', access_point.ifconfig())
+logger.info("Access Point Active: %s", access_point.ifconfig())
 
-print("Set up pump")
-pump = Pump(access_point)
+logger.info("Set up pump")
+shelly = ShellyClient()
+pump = Pump(shelly)
 if persistent_state.state["pump_status"] == Pump.ON:
     pump.start()
 elif persistent_state.state["pump_status"] == Pump.OFF:
     pump.stop()
 
-print("Set up Temp Sensors")
-temp_sensors = TempSensors(32, 33)
-ambient_temp = temp_sensors.get_sensor(0, "ambient_temp")
-primary_supply_temp = temp_sensors.get_sensor(1, "primary_supply_temp")
-primary_return_temp = temp_sensors.get_sensor(2, "primary_return_temp")
-secondary_supply_temp = temp_sensors.get_sensor(3, "secondary_supply_temp")
-secondary_return_temp = temp_sensors.get_sensor(4, "secondary_return_temp")
+logger.info("Set up Temp Sensors")
+# On first boot probes are bound to these names in bus order, after that
+# by ROM code from sensors.json
+temp_sensors = TempSensors(
+    (32, 33),
+    ("ambient_temp", "primary_supply_temp", "primary_return_temp",
+     "secondary_supply_temp", "secondary_return_temp"))
+# Outdoor air moves slowly, the regulated supply temperature is sampled fast
+ambient_temp = temp_sensors.get_sensor("ambient_temp", period=60000)
+primary_supply_temp = temp_sensors.get_sensor("primary_supply_temp", period=5000)
+primary_return_temp = temp_sensors.get_sensor("primary_return_temp", period=5000)
+secondary_supply_temp = temp_sensors.get_sensor("secondary_supply_temp", resolution=11, period=1000)
+secondary_return_temp = temp_sensors.get_sensor("secondary_return_temp", period=5000)
 
-print("Set up Valve")
+logger.info("Set up Valve")
 pin_open_valve = Pin(19, Pin.OUT, value=1)
 pin_close_valve = Pin(18, Pin.OUT, value=1)
+# Optional end stop switches, [closed pin, open pin], pulled low at the stop
+end_stop_pins = settings.get("valve", {}).get("end_stops")
 valve = Valve(
     pin_open_valve,
-    pin_close_valve)
+    pin_close_valve,
+    Timer(0),
+    end_stops=tuple(Pin(n, Pin.IN, Pin.PULL_UP) for n in end_stop_pins) if end_stop_pins else None)
 valve.position = persistent_state.state["valve_position"]
+valve.stroke_time = persistent_state.state["valve_stroke_time"]
+valve.position_error = persistent_state.state["valve_position_error"]
 
-print("set up Regulator")
+logger.info("set up Regulator")
 regulator = Regulator(
     primary_supply_temp=primary_supply_temp,
     secondary_supply_temp=secondary_supply_temp,
@@ -89,6 +106,12 @@ regulator.mode = persistent_state.state["regulator_mode"]
 regulator.gain = persistent_state.state["curve_gain"]
 regulator.offset = persistent_state.state["base_temp"]
 regulator.proportional_gain = persistent_state.state["proportional_gain"]
+regulator.algorithm = persistent_state.state["regulator_algorithm"]
+regulator.integral_time = persistent_state.state["integral_time"]
+regulator.derivative_time = persistent_state.state["derivative_time"]
+regulator.feed_forward_gain = persistent_state.state["feed_forward_gain"]
+regulator.adjustment_interval = persistent_state.state["adjustment_interval"]
+regulator.adjustment_threshold = persistent_state.state["adjustment_threshold"]
 
 system = SystemController(
     regulator=regulator,
@@ -99,21 +122,36 @@ system = SystemController(
     primary_return_temp=primary_return_temp,
     secondary_supply_temp=secondary_supply_temp,
     secondary_return_temp=secondary_return_temp)
+temp_sensors.events = system.events
+autotune = system.autotune
+autotune.process_gain = persistent_state.state["autotune_process_gain"]
+autotune.dead_time = persistent_state.state["autotune_dead_time"]
+autotune.time_constant = persistent_state.state["autotune_time_constant"]
+system.events.subscribe(persistent_state.on_event, VALVE | PUMP | REGULATOR)
 
-print("set up MQTT Controller")
+# An empty host trusts the RTC as it is
+timesync = TimeSync(wifi_client, host=settings.get("ntp", {}).get("host", "pool.ntp.org"))
+
+logger.info("set up MQTT Controller")
 mqtt = MQTTController(
     mqtt_settings=settings["mqtt"],
-    system=system)
+    system=system,
+    timesync=timesync)
+connections = ConnectionManager(
+    wifi_client,
+    mqtt,
+    settings["station"]["ssid"],
+    settings["station"]["password"])
 
 def cleanup():
     try:
         access_point.active(False)
         wifi_client.active(False)
-        persistent_state.update(system)
         persistent_state.save()
-        print("Shutdown complete")
+        archive.flush()
+        logger.info("Shutdown complete")
     except Exception as e:
-        print(f"Error during shutdown: {e}")
+        logger.error("Error during shutdown: %s", e)
 
 
 def reset():
@@ -121,55 +159,129 @@ def reset():
     cleanup()
     machine.reset()
 
-print("set up HTTP View")
+logger.info("set up History")
+# Default 24 h at 1 minute resolution
+history_settings = settings.get("history", {})
+history = History(timesync, length=history_settings.get("length", 1440))
+for sensor in (ambient_temp, primary_supply_temp, primary_return_temp,
+               secondary_supply_temp, secondary_return_temp):
+    history.add_column(sensor.name(),
+                       lambda sensor=sensor: None if sensor.is_stale() else sensor.value())
+history.add_column("valve_position", lambda: valve.position)
+history.add_column("pump",
+                   lambda: None if pump.status == Pump.UNKNOWN else int(pump.status == Pump.ON),
+                   scale=1)
+history.add_column("regulation_adjustment", lambda: regulator.regulation_adjustment)
+
+logger.info("set up Archive")
+archive_settings = settings.get("archive", {})
+archive = Archive(
+    len(history.columns),
+    segment_size=archive_settings.get("segment_size", 65536),
+    max_segments=archive_settings.get("max_segments", 16))
+
+def archive_sample():
+    # The archive outlives a reboot, so only samples with a wall-clock time
+    t = timesync.epoch(time.ticks_ms())
+    if t is not None:
+        archive.append(t, history.sample())
+
+logger.info("set up Backfill")
+# Default 4 h at 30 s while the broker is unreachable, no spill to flash
+backfill_settings = settings.get("backfill", {})
+backfill = Backfill(
+    history,
+    timesync,
+    length=backfill_settings.get("length", 480),
+    batch=backfill_settings.get("batch", 10),
+    spill_size=backfill_settings.get("spill_size", 0))
+mqtt.backfill = backfill
+
+def backfill_sample():
+    if not mqtt.connected:
+        backfill.record()
+
+logger.info("set up HTTP View")
 http_v = HTTPView(
     wifi_client,
     access_point,
     mqtt = mqtt,
+    connections=connections,
     system=system,
     port=settings["web_server"]["port"],
-    reset_function=reset)
+    reset_function=reset,
+    history=history,
+    archive=archive,
+    timesync=timesync,
+    backfill=backfill)
 http_v.add_sensor(ambient_temp)
 http_v.add_sensor(primary_supply_temp)
 http_v.add_sensor(primary_return_temp)
 http_v.add_sensor(secondary_supply_temp)
 http_v.add_sensor(secondary_return_temp)
-http_v.start()
 
-print("Starting main loop")
-loop_time = 1000 # ms
+def refresh_pump():
+    pump.refresh()
+    if pump.status == Pump.UNKNOWN:
+        pump_led.on()
+    else:
+        pump_led.switch()
+
+def publish_telemetry():
+    mqtt.execute()
+    if mqtt.connected:
+        mqtt_led.switch()
+    else:
+        mqtt_led.on()
+
+def collect_garbage():
+    main_led.switch()
+    gc.collect()
+    metrics.sample_heap()
+
+# The regulator counts in whole seconds and must keep a 1 s period, the
+# valve task only books finished pulses, which a timer ends on time.
+# The sensor pipeline does at most one 1-Wire transaction per bus per run.
+tasks = [
+    PeriodicTask("pump", 1000, refresh_pump, deadline=50),
+    PeriodicTask("valve", 1000, valve.refresh, deadline=20),
+    PeriodicTask("sensors", 100, temp_sensors.scan, deadline=50),
+    PeriodicTask("sensor_rescan", 30000, temp_sensors.rescan, deadline=500),
+    PeriodicTask("regulator", 1000, regulator.regulate, deadline=20),
+    PeriodicTask("autotune", 1000, autotune.run, deadline=20),
+    PeriodicTask("mqtt", 1000, publish_telemetry, deadline=200),
+    PeriodicTask("mqtt_rx", 100, mqtt.receive, deadline=50),
+    PeriodicTask("status", 1000, http_v.publish_status, deadline=50),
+    PeriodicTask("persistence", 1000, persistent_state.update, deadline=500),
+    PeriodicTask("connections", 200, connections.run, deadline=50),
+    PeriodicTask("time", 1000, timesync.run, deadline=50),
+    PeriodicTask("backfill", backfill_settings.get("interval", 30) * 1000, backfill_sample, deadline=50),
+    PeriodicTask("gc", 1000, collect_garbage, deadline=100),
+    PeriodicTask("history", history_settings.get("interval", 60) * 1000, history.record, deadline=20),
+    PeriodicTask("archive", archive_settings.get("interval", 20) * 1000, archive_sample, deadline=200),
+]
+# Optional periodic metrics digest over MQTT, in seconds
+if settings["mqtt"].get("metrics_interval"):
+    tasks.append(PeriodicTask(
+        "metrics", settings["mqtt"]["metrics_interval"] * 1000, mqtt.publish_metrics))
+
+async def run():
+    await asyncio.gather(
+        shelly.run(),
+        http_v.serve(),
+        *(task.run() for task in tasks))
+
+logger.info("Starting main loop")
 try:
-    while True:
-        start_loop_time = time.ticks_ms()
-        main_led.switch()
-        pump.refresh()
-        if pump.status == Pump.UNKNOWN:
-            pump_led.on()
-        else:
-            pump_led.switch()
-        valve.refresh()
-        temp_sensors.scan()
-        mqtt.execute()
-        if mqtt.connected:
-            mqtt_led.switch()
-        else:
-            mqtt_led.on()
-        regulator.regulate()
-        ensure_connections()
-        persistent_state.update(system)
-        gc.collect()
-        loop_time = time.ticks_ms() - start_loop_time
-        print(f"loop time: {loop_time}")
-        sleep_time = max(0, 1000 - loop_time)
-        time.sleep_ms(sleep_time)
+    asyncio.run(run())
 
 except KeyboardInterrupt:
-    print("Stopping...")
+    logger.info("Stopping...")
     cleanup()
 
 
 except Exception as e:
     # Other errors - clean shutdown and reset
-    print(f"Unexpected error: {e}")
-    print("Performing reset...")
+    logger.error("Unexpected error: %s", e)
+    logger.error("Performing reset...")
     reset()
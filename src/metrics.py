@@ -0,0 +1,127 @@
+import gc
+from array import array
+
+# Upper bounds of the stage duration buckets in µs, a last bucket catches the rest
+BUCKETS_US = (100, 500, 1000, 5000, 10000, 50000, 100000, 500000, 1000000)
+
+# The µs sum wraps here and counts the wraps, so it stays a small int on
+# MicroPython (below 2^30) and observe() does not allocate
+SUM_WRAP = 1 << 29
+
+COUNTERS = ("overruns", "task_errors", "sensor_read_errors", "mqtt_disconnects",
+            "http_requests", "shelly_failures", "connection_failures",
+            "backfill_dropped")
+
+
+class Histogram:
+    """ Fixed-bucket duration histogram. Observing a value only updates
+    preallocated arrays, so it is safe to call on every task run. """
+
+    def __init__(self, name, buckets=BUCKETS_US):
+        self.name = name
+        self.buckets = buckets
+        self.counts = array('L', [0] * (len(buckets) + 1))
+        # count, sum and max in µs, and the wraps of the sum at SUM_WRAP
+        self.totals = array('L', [0, 0, 0, 0])
+
+    def observe(self, us):
+        i = 0
+        for bound in self.buckets:
+            if us <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        totals = self.totals
+        totals[0] += 1
+        total = totals[1] + us
+        if total >= SUM_WRAP:
+            total -= SUM_WRAP
+            totals[3] += 1
+        totals[1] = total
+        if us > totals[2]:
+            totals[2] = us
+
+    def count(self):
+        return self.totals[0]
+
+    def sum_us(self):
+        return self.totals[3] * SUM_WRAP + self.totals[1]
+
+    def mean_us(self):
+        return self.sum_us() // self.totals[0] if self.totals[0] else 0
+
+    def max_us(self):
+        return self.totals[2]
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = []
+        self.counters = {}
+        for name in COUNTERS:
+            self.counters[name] = 0
+        # min, max, sum and number of free heap samples
+        self.heap = [None, None, 0, 0]
+
+    def histogram(self, name):
+        histogram = Histogram(name)
+        self.histograms.append(histogram)
+        return histogram
+
+    def inc(self, name):
+        self.counters[name] += 1
+
+    def sample_heap(self):
+        mem_free = getattr(gc, "mem_free", None)
+        if mem_free is None:
+            return  # Not available on CPython
+        free = mem_free()
+        heap = self.heap
+        if heap[0] is None or free < heap[0]:
+            heap[0] = free
+        if heap[1] is None or free > heap[1]:
+            heap[1] = free
+        heap[2] += free
+        heap[3] += 1
+
+    def heap_stats(self):
+        low, high, total, samples = self.heap
+        return low, high, total // samples if samples else None
+
+    def render(self):
+        """ Yields the metrics in Prometheus text format, one line at a time. """
+        yield "# TYPE heat_stage_duration_seconds histogram\n"
+        for h in self.histograms:
+            cumulative = 0
+            for i, bound in enumerate(h.buckets):
+                cumulative += h.counts[i]
+                yield f'heat_stage_duration_seconds_bucket{{stage="{h.name}",le="{bound / 1000000}"}} {cumulative}\n'
+            yield f'heat_stage_duration_seconds_bucket{{stage="{h.name}",le="+Inf"}} {h.count()}\n'
+            yield f'heat_stage_duration_seconds_sum{{stage="{h.name}"}} {h.sum_us() / 1000000}\n'
+            yield f'heat_stage_duration_seconds_count{{stage="{h.name}"}} {h.count()}\n'
+        yield "# TYPE heat_stage_duration_max_seconds gauge\n"
+        for h in self.histograms:
+            yield f'heat_stage_duration_max_seconds{{stage="{h.name}"}} {h.max_us() / 1000000}\n'
+        for name, value in self.counters.items():
+            yield f"# TYPE heat_{name}_total counter\nheat_{name}_total {value}\n"
+        low, high, mean = self.heap_stats()
+        if mean is not None:
+            yield "# TYPE heat_heap_free_bytes gauge\n"
+            yield f'heat_heap_free_bytes{{stat="min"}} {low}\n'
+            yield f'heat_heap_free_bytes{{stat="max"}} {high}\n'
+            yield f'heat_heap_free_bytes{{stat="mean"}} {mean}\n'
+
+    def digest(self):
+        """ Compact summary for the periodic MQTT digest. """
+        low, high, mean = self.heap_stats()
+        stages = {}
+        for h in self.histograms:
+            stages[h.name] = [h.mean_us(), h.max_us(), h.count()]
+        return {
+            "counters": self.counters,
+            "heap": [low, high, mean],
+            "stages": stages,
+        }
+
+
+metrics = Metrics()
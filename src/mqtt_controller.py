@@ -1,29 +1,136 @@
 from regulator import Regulator
-from umqtt.simple import MQTTClient
+from mqttsimple import MQTTClient
+from telemetry import TelemetryPublisher, FramePublisher
+from telemetry_frame import FrameEncoder
+from autotune import Autotune
+from events import VALVE, PUMP, REGULATOR, SENSOR
+from metrics import metrics
+import json
+import log
+
+logger = log.get_logger("mqtt")
+
+TEMPERATURE_DEADBAND = 0.1  # °C
+CONFIG_INTERVAL = 3600000  # ms, heartbeat for retained configuration values
 
 
 class MQTTController:
-    def __init__(self, mqtt_settings, system):
+    def __init__(self, mqtt_settings, system, timesync):
         self.client = MQTTClient(
             client_id=mqtt_settings["client_id"],
             server=mqtt_settings["broker"],
             user=mqtt_settings["user"],
-            password=mqtt_settings["password"])
+            password=mqtt_settings["password"],
+            keepalive=mqtt_settings.get("keepalive", 60),
+            window=mqtt_settings.get("window", 8))
         self.system = system
 
         self.topic_prefix = mqtt_settings["topic_prefix"]
         self.connected = False
+        self.backfill = None  # Samples taken while offline, see Backfill
+        self._backfill_topic = f"{self.topic_prefix}/backfill"
 
-    def connect(self):
-        try:
-            self.client.connect()
-            self.client.set_callback(self.incomming_message)
-            self.client.subscribe(f"{self.topic_prefix}/set_mode")
-            self.connected = True
-            print("MQTT Connected")
-        except:
-            self.connected = False
-            print("MQTT Connection failed")
+        regulator = system.regulator
+        sensors = (system.ambient_temp, system.primary_supply_temp,
+                   system.primary_return_temp, system.secondary_supply_temp,
+                   system.secondary_return_temp)
+        # "topics" publishes a topic per value, "frame" the live values in
+        # one binary frame on <prefix>/frame, "both" does both
+        mode = mqtt_settings.get("telemetry", "topics")
+        telemetry = TelemetryPublisher(self.client, self.topic_prefix)
+        if mode != "frame":
+            telemetry.add("pump_status", lambda: system.pump.status, retain=True, qos=1)
+            telemetry.add("pump_power", lambda: system.pump.power, deadband=1, min_interval=10000)
+            telemetry.add("valve_position", lambda: system.valve.position)
+            telemetry.add("valve_position_error", lambda: system.valve.position_error,
+                          deadband=0.5, min_interval=10000)
+            telemetry.add("regulation_adjustment", lambda: regulator.regulation_adjustment,
+                          deadband=0.1, min_interval=5000)
+            for sensor in sensors:
+                telemetry.add(sensor.name(), sensor.value,
+                              deadband=TEMPERATURE_DEADBAND, min_interval=5000)
+        telemetry.add("valve_stroke_time", lambda: system.valve.stroke_time,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        telemetry.add("regulator_mode", lambda: regulator.mode,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        telemetry.add("curve_gain", lambda: regulator.gain,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        telemetry.add("offset", lambda: regulator.offset,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        telemetry.add("proportional_gain", lambda: regulator.proportional_gain,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        telemetry.add("regulator_algorithm", lambda: regulator.algorithm,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        telemetry.add("integral_time", lambda: regulator.integral_time,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        telemetry.add("derivative_time", lambda: regulator.derivative_time,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        telemetry.add("feed_forward_gain", lambda: regulator.feed_forward_gain,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        telemetry.add("adjustment_threshold", lambda: regulator.adjustment_threshold,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        telemetry.add("adjustment_interval", lambda: regulator.adjustment_interval,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        telemetry.add("autotune_state", lambda: system.autotune.state,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        telemetry.add("autotune_result", system.autotune.result,
+                      retain=True, qos=1, max_interval=CONFIG_INTERVAL)
+        self.telemetry = telemetry
+        self.frame = None
+        if mode != "topics":
+            getters = {
+                "desired_temp": regulator.desired_secondary_supply_temp,
+                "valve_position": lambda: system.valve.position,
+                "valve_position_error": lambda: system.valve.position_error,
+                "regulation_adjustment": lambda: regulator.regulation_adjustment,
+                "pump_energy": lambda: system.pump.power,
+                "pump_status": lambda: system.pump.status,
+                "regulator_mode": lambda: regulator.mode,
+                "regulator_algorithm": lambda: regulator.algorithm,
+            }
+            for sensor in sensors:
+                getters[sensor.name()] = (
+                    lambda sensor=sensor: None if sensor.is_stale() else sensor.value())
+            self.frame = FramePublisher(self.client, f"{self.topic_prefix}/frame",
+                                        FrameEncoder(getters), timesync)
+            system.events.subscribe(self.frame.on_event, VALVE | PUMP | REGULATOR | SENSOR)
+        # Numeric settings accepted on <prefix>/set_<name>
+        self._setters = {
+            "proportional_gain": regulator.set_proportional_gain,
+            "integral_time": regulator.set_integral_time,
+            "derivative_time": regulator.set_derivative_time,
+            "feed_forward_gain": regulator.set_feed_forward_gain,
+            "adjustment_interval": regulator.set_adjustment_interval,
+            "adjustment_threshold": regulator.set_adjustment_threshold,
+        }
+        system.events.subscribe(telemetry.on_event, VALVE | PUMP | REGULATOR | SENSOR)
+
+    def begin_connect(self):
+        """ Starts connecting to the broker, see ConnectionManager. """
+        self.client.begin_connect()
+
+    def poll_connect(self):
+        """ True once the broker accepted the connection. The subscriptions
+        go out without waiting for their SUBACKs. """
+        if self.client.poll_connect() is None:
+            return False
+        self.client.set_callback(self.incomming_message)
+        self.client.subscribe(f"{self.topic_prefix}/set_mode", wait=False)
+        self.client.subscribe(f"{self.topic_prefix}/set_algorithm", wait=False)
+        self.client.subscribe(f"{self.topic_prefix}/calibrate_valve", wait=False)
+        self.client.subscribe(f"{self.topic_prefix}/autotune", wait=False)
+        for name in self._setters:
+            self.client.subscribe(f"{self.topic_prefix}/set_{name}", wait=False)
+        self.telemetry.reset()
+        if self.frame is not None:
+            self.frame.reset()
+        self.connected = True
+        logger.info("MQTT Connected")
+        return True
+
+    def abort_connect(self):
+        self.connected = False
+        self.client.abort_connect()
 
     def disconnect(self):
         self.client.disconnect()
@@ -35,59 +142,62 @@ class MQTTController:
             return
 
         try:
-            self.client.publish(
-                f"{self.topic_prefix}/pump_status",
-                str(self.system.pump.status))
-            self.client.publish(
-                f"{self.topic_prefix}/pump_power",
-                str(self.system.pump.power))
-            self.client.publish(
-                f"{self.topic_prefix}/valve_position",
-                str(self.system.valve.position))
-            self.client.publish(
-                f"{self.topic_prefix}/regulator_mode",
-                str(self.system.regulator.mode))
-            self.client.publish(
-                f"{self.topic_prefix}/regulation_adjustment",
-                str(self.system.regulator.regulation_adjustment))
-            self.client.publish(
-                f"{self.topic_prefix}/curve_gain",
-                str(self.system.regulator.gain))
-            self.client.publish(
-                f"{self.topic_prefix}/offset",
-                str(self.system.regulator.offset))
-            self.client.publish(
-                f"{self.topic_prefix}/proportional_gain",
-                str(self.system.regulator.proportional_gain))
-            self.client.publish(
-                f"{self.topic_prefix}/adjustment_threshold",
-                str(self.system.regulator.adjustment_threshold))
-            self.client.publish(
-                f"{self.topic_prefix}/ambient_temp",
-                str(self.system.ambient_temp.value()))
-            self.client.publish(
-                f"{self.topic_prefix}/primary_supply_temp",
-                str(self.system.primary_supply_temp.value()))
-            self.client.publish(
-                f"{self.topic_prefix}/primary_return_temp",
-                str(self.system.primary_return_temp.value()))
-            self.client.publish(
-                f"{self.topic_prefix}/secondary_supply_temp",
-                str(self.system.secondary_supply_temp.value()))
-            self.client.publish(
-                f"{self.topic_prefix}/secondary_return_temp",
-                str(self.system.secondary_return_temp.value()))
-            self.client.check_msg()
+            self.telemetry.publish()
+            if self.frame is not None:
+                self.frame.publish()
+            if self.backfill is not None:
+                self.backfill.drain(self.client, self._backfill_topic)
+        except Exception as e:
+            self._failed(e)
+
+    def receive(self):
+        """ Handles pending commands without blocking. """
+        if not self.connected:
+            return
+
+        try:
+            if self.client.check_msg() == 0x90 and self.client.rx_code == 0x80:
+                logger.warning("Subscription %d refused", self.client.rx_pid)
         except Exception as e:
-            print(f"MQTT failure {e}, disconnecting")
+            self._failed(e)
+
+    def publish_metrics(self):
+        """ Periodic digest of the loop metrics, see Metrics.digest(). """
+        if not self.connected:
+            return
+
+        try:
+            self.client.publish(f"{self.topic_prefix}/metrics", json.dumps(metrics.digest()))
+        except Exception as e:
+            self._failed(e)
+
+    def _failed(self, e):
+        metrics.inc("mqtt_disconnects")
+        logger.error("MQTT failure %s, disconnecting", e)
+        self.connected = False
+        try:
             self.client.disconnect()
-            self.connected = False
+        except Exception:
+            pass
 
     def incomming_message(self, b_topic, b_value):
         value = b_value.decode()
         topic = b_topic.decode()
+        name = topic[len(self.topic_prefix) + 5:]  # After "<prefix>/set_"
         if ( topic == f"{self.topic_prefix}/set_mode"
              and (value == Regulator.AUTOMATIC or value == Regulator.MANUAL)):
             self.system.regulator.set_mode(value)
+        elif ( topic == f"{self.topic_prefix}/set_algorithm"
+               and value in Regulator.ALGORITHMS):
+            self.system.regulator.set_algorithm(value)
+        elif topic == f"{self.topic_prefix}/calibrate_valve":
+            self.system.valve.calibrate()
+        elif topic == f"{self.topic_prefix}/autotune" and value in Autotune.ACTIONS:
+            getattr(self.system.autotune, value)()
+        elif topic.startswith(f"{self.topic_prefix}/set_") and name in self._setters:
+            try:
+                self._setters[name](float(value))
+            except ValueError:
+                logger.warning("incorrect value for %s: %s", name, value)
         else:
-            print(f"incorrect value: {value}")
+            logger.warning("incorrect value: %s", value)
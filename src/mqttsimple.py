@@ -2,16 +2,37 @@ try:
     import usocket as socket
 except:
     import socket
+import time
 import ustruct as struct
+try:
+    import uselect as select
+except:
+    import select
+try:
+    import uerrno as errno
+except:
+    import errno
 from ubinascii import hexlify
 
+# Fixed header (1), remaining length (up to 4), topic length (2) and pid (2)
+_PUBLISH_OVERHEAD = 9
+
+# Steps of a non-blocking connect
+_TCP = 1  # Waiting for the TCP connection
+_CONNACK = 2  # CONNECT sent, waiting for the reply
+
+
+def _to_bytes(s):
+    return s.encode() if isinstance(s, str) else s
+
+
 class MQTTException(Exception):
     pass
 
 class MQTTClient:
 
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
-                 ssl=False, ssl_params={}):
+                 ssl=False, ssl_params={}, timeout=1000, window=8):
         if port == 0:
             port = 8883 if ssl else 1883
         self.client_id = client_id
@@ -29,20 +50,132 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        self._wbuf = bytearray(256)
+        self._rbuf = bytearray(512)
+        self._rview = memoryview(self._rbuf)
+        self._rlen = 0  # Bytes received but not yet parsed
+        self._rpoll = None
+        self._wpoll = None
+        self._ack = bytearray(b"\x40\x02\0\0")
+        self.rx_pid = 0  # Packet id of the last PUBACK/SUBACK
+        self.rx_code = 0  # Return code of the last SUBACK
+        self.timeout = timeout  # ms a write may wait for the socket
+        self._addr = None  # Resolved server address
+        self._connecting = None  # Step of a running non-blocking connect
+        self._clean_session = True
+        # QoS 1 PUBLISH packets waiting for their PUBACK, oldest first, as
+        # [pid, packet]. At most window of them.
+        self.window = window
+        self._inflight = []
+        self._last_tx = 0  # ticks_ms of the last packet sent
+        self._last_rx = 0  # ticks_ms of the last bytes received
+        self._ping_sent = False  # A PINGREQ is waiting for any reply
 
     def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+        self._write(struct.pack("!H", len(s)))
+        self._write(_to_bytes(s))
+
+    # Write n bytes of buf to the non-blocking socket, waiting up to
+    # timeout ms for room in the send buffer when needed.
+    def _write(self, buf, n=-1):
+        if n < 0:
+            n = len(buf)
+        mv = memoryview(buf)
+        pos = 0
+        while pos < n:
+            w = self.sock.write(mv[pos:n])
+            if w:
+                pos += w
+            elif not self._wpoll.poll(self.timeout):
+                raise OSError(errno.ETIMEDOUT)
+        self._last_tx = time.ticks_ms()
+
+    # Read whatever the socket has into the receive buffer with a single
+    # readinto. Returns the number of new bytes, 0 if nothing was pending.
+    def _fill(self):
+        if self._rlen == len(self._rbuf):
+            buf = bytearray(2 * len(self._rbuf))
+            buf[:self._rlen] = self._rbuf
+            self._rbuf = buf
+            self._rview = memoryview(buf)
+        n = self.sock.readinto(self._rview[self._rlen:])
+        if n is None:
+            return 0
+        if n == 0:
+            raise OSError(-1)
+        self._rlen += n
+        self._last_rx = time.ticks_ms()
+        self._ping_sent = False
+        return n
 
-    def _recv_len(self):
+    # Locate the first complete packet in the receive buffer. Returns
+    # (body start, packet end) or None while it is still incomplete.
+    def _next_packet(self):
+        buf = self._rbuf
         n = 0
         sh = 0
+        i = 1
         while 1:
-            b = self.sock.read(1)[0]
+            if i >= self._rlen:
+                return None
+            b = buf[i]
             n |= (b & 0x7f) << sh
+            i += 1
             if not b & 0x80:
-                return n
+                break
             sh += 7
+        if i + n > self._rlen:
+            if i + n > len(buf):
+                # Make room for a packet larger than the buffer
+                grown = bytearray(i + n)
+                grown[:self._rlen] = buf[:self._rlen]
+                self._rbuf = grown
+                self._rview = memoryview(grown)
+            return None
+        return i, i + n
+
+    def _consume(self, end):
+        rest = self._rlen - end
+        if rest:
+            self._rbuf[:rest] = self._rview[end:self._rlen]
+        self._rlen = rest
+
+    # Handle one complete packet at the start of the receive buffer and
+    # return its type, or None for PUBLISH and PINGRESP.
+    def _process(self, start, end):
+        mv = self._rview
+        op = self._rbuf[0]
+        if op & 0xf0 == 0x30:
+            topic_len = mv[start] << 8 | mv[start + 1]
+            pos = start + 2
+            topic = bytes(mv[pos:pos + topic_len])
+            pos += topic_len
+            pid = 0
+            if op & 6:
+                pid = mv[pos] << 8 | mv[pos + 1]
+                pos += 2
+            msg = bytes(mv[pos:end])
+            self._consume(end)
+            self.cb(topic, msg)
+            if op & 6 == 2:
+                struct.pack_into("!H", self._ack, 2, pid)
+                self._write(self._ack)
+            elif op & 6 == 4:
+                assert 0
+            return None
+        if end - start >= 2:
+            self.rx_pid = mv[start] << 8 | mv[start + 1]
+        if end - start >= 3:
+            self.rx_code = mv[start + 2]
+        self._consume(end)
+        if op == 0xd0:  # PINGRESP
+            return None
+        if op == 0x40:  # PUBACK
+            for i, entry in enumerate(self._inflight):
+                if entry[0] == self.rx_pid:
+                    self._inflight.pop(i)
+                    break
+        return op
 
     def set_callback(self, f):
         self.cb = f
@@ -55,13 +188,80 @@ class MQTTClient:
         self.lw_qos = qos
         self.lw_retain = retain
 
-    def connect(self, clean_session=True):
+    # Start a non-blocking connect. Call poll_connect() until it returns
+    # the session present flag. The server name is resolved once and the
+    # address kept until an attempt fails, as getaddrinfo() blocks.
+    def begin_connect(self, clean_session=True):
+        if self._addr is None:
+            self._addr = socket.getaddrinfo(self.server, self.port)[0][-1]
         self.sock = socket.socket()
-        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
-        self.sock.connect(addr)
-        if self.ssl:
-            import ussl
-            self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
+        self.sock.setblocking(False)
+        try:
+            self.sock.connect(self._addr)
+        except OSError as e:
+            if e.args[0] not in (errno.EINPROGRESS, errno.EAGAIN):
+                self.abort_connect()
+                raise
+        self._rlen = 0
+        self._rpoll = select.poll()
+        self._rpoll.register(self.sock, select.POLLIN)
+        self._wpoll = select.poll()
+        self._wpoll.register(self.sock, select.POLLOUT)
+        self._clean_session = clean_session
+        self._connecting = _TCP
+
+    # Advance a connect started by begin_connect() without blocking.
+    # Returns None while it is in progress.
+    def poll_connect(self):
+        try:
+            if self._connecting == _TCP:
+                events = self._wpoll.poll(0)
+                if not events:
+                    return None
+                if events[0][1] & (select.POLLERR | select.POLLHUP):
+                    raise OSError(errno.ECONNREFUSED)
+                if self.ssl:
+                    import ussl
+                    self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
+                self._send_connect(self._clean_session)
+                self._connecting = _CONNACK
+            pkt = self._next_packet()
+            if pkt is None:
+                self._fill()
+                pkt = self._next_packet()
+                if pkt is None:
+                    return None
+            start, end = pkt
+            if self._rbuf[0] != 0x20 or end - start != 2:
+                raise MQTTException(-1)
+            present = self._rbuf[start] & 1
+            code = self._rbuf[start + 1]
+            self._consume(end)
+            if code != 0:
+                raise MQTTException(code)
+            # Send what the old connection left unacknowledged again, in
+            # order and marked as duplicates
+            for entry in self._inflight:
+                entry[1][0] |= 0x08
+                self._write(entry[1])
+        except Exception:
+            self.abort_connect()
+            raise
+        self._connecting = None
+        self._last_rx = self._last_tx
+        self._ping_sent = False
+        return present
+
+    def abort_connect(self):
+        self._connecting = None
+        self._addr = None
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def _send_connect(self, clean_session):
         premsg = bytearray(b"\x10\0\0\0\0\0")
         msg = bytearray(b"\x04MQTT\x04\x02\0\0")
 
@@ -86,8 +286,8 @@ class MQTTClient:
             i += 1
         premsg[i] = sz
 
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
+        self._write(premsg, i + 2)
+        self._write(msg)
         #print(hex(len(msg)), hexlify(msg, ":"))
         self._send_str(self.client_id)
         if self.lw_topic:
@@ -96,71 +296,155 @@ class MQTTClient:
         if self.user is not None:
             self._send_str(self.user)
             self._send_str(self.pswd)
-        resp = self.sock.read(4)
-        assert resp[0] == 0x20 and resp[1] == 0x02
-        if resp[3] != 0:
-            raise MQTTException(resp[3])
-        return resp[2] & 1
+
+    # Blocking connect, polls a non-blocking one to completion
+    def connect(self, clean_session=True):
+        self.begin_connect(clean_session)
+        while 1:
+            present = self.poll_connect()
+            if present is not None:
+                return present
+            if self._connecting == _TCP:
+                self._wpoll.poll(self.timeout)
+            else:
+                self._rpoll.poll(self.timeout)
 
     def disconnect(self):
-        self.sock.write(b"\xe0\0")
-        self.sock.close()
+        try:
+            self._write(b"\xe0\0")
+        finally:
+            # Close even when the write fails, the ESP32 has few sockets
+            self.sock.close()
 
     def ping(self):
-        self.sock.write(b"\xc0\0")
+        self._write(b"\xc0\0")
+        self._ping_sent = True
 
-    def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
+    # Ping when the connection has been quiet for half the keepalive in
+    # either direction. Raises OSError when the broker has sent nothing
+    # for a whole keepalive, pings included.
+    def _keepalive(self):
+        if not self.keepalive:
+            return
+        now = time.ticks_ms()
+        silent = time.ticks_diff(now, self._last_rx)
+        if silent >= self.keepalive * 1000:
+            raise OSError(errno.ETIMEDOUT)
+        if not self._ping_sent and (
+                silent >= self.keepalive * 500
+                or time.ticks_diff(now, self._last_tx) >= self.keepalive * 500):
+            self.ping()
+
+    def _reserve(self, size):
+        if len(self._wbuf) < size:
+            self._wbuf = bytearray(size)
+
+    # Encode a PUBLISH packet into the write buffer at pos and return the
+    # position after it. The buffer must already have room for it.
+    def _pack_publish(self, pos, topic, msg, retain, qos, pid):
+        buf = self._wbuf
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
         assert sz < 2097152
-        i = 1
+        buf[pos] = 0x30 | qos << 1 | retain
+        pos += 1
         while sz > 0x7f:
-            pkt[i] = (sz & 0x7f) | 0x80
+            buf[pos] = (sz & 0x7f) | 0x80
             sz >>= 7
-            i += 1
-        pkt[i] = sz
-        #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+            pos += 1
+        buf[pos] = sz
+        pos += 1
+        n = len(topic)
+        buf[pos] = n >> 8
+        buf[pos + 1] = n & 0xff
+        pos += 2
+        buf[pos:pos + n] = topic
+        pos += n
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
-
-    def subscribe(self, topic, qos=0):
+            buf[pos] = pid >> 8
+            buf[pos + 1] = pid & 0xff
+            pos += 2
+        n = len(msg)
+        buf[pos:pos + n] = msg
+        return pos + n
+
+    # QoS 0 is written and forgotten. QoS 1 returns the packet id without
+    # waiting for the PUBACK, which check_msg() picks up later, or None
+    # when the in-flight window is full and nothing was sent.
+    def publish(self, topic, msg, retain=False, qos=0):
+        if qos == 2:
+            raise MQTTException("QoS 2 is not supported")
+        if qos == 1 and len(self._inflight) >= self.window:
+            self.check_msg()
+            if len(self._inflight) >= self.window:
+                return None
+        topic = _to_bytes(topic)
+        msg = _to_bytes(msg)
+        self._reserve(len(topic) + len(msg) + _PUBLISH_OVERHEAD)
+        pid = 0
+        if qos:
+            pid = self._next_pid()
+        n = self._pack_publish(0, topic, msg, retain, qos, pid)
+        #print(hex(n), hexlify(self._wbuf[:n], ":"))
+        if qos:
+            # Kept until the PUBACK, even when the write fails, so that it
+            # goes out again after the reconnect
+            self._inflight.append([pid, bytearray(self._wbuf[:n])])
+        self._write(self._wbuf, n)
+        return pid or None
+
+    def _next_pid(self):
+        # 1..65535, skipping ids still waiting for their PUBACK
+        while 1:
+            self.pid = self.pid % 65535 + 1
+            for entry in self._inflight:
+                if entry[0] == self.pid:
+                    break
+            else:
+                return self.pid
+
+    def inflight(self):
+        """ QoS 1 messages waiting for their PUBACK. """
+        return len(self._inflight)
+
+    # Publish a batch of (topic, msg) or (topic, msg, retain) entries at
+    # QoS 0 with a single socket write.
+    def publish_many(self, msgs, retain=False):
+        msgs = [(_to_bytes(m[0]), _to_bytes(m[1]), m[2] if len(m) > 2 else retain)
+                for m in msgs]
+        size = 0
+        for topic, msg, _ in msgs:
+            size += len(topic) + len(msg) + _PUBLISH_OVERHEAD
+        self._reserve(size)
+        n = 0
+        for topic, msg, r in msgs:
+            n = self._pack_publish(n, topic, msg, r, 0, 0)
+        if n:
+            self._write(self._wbuf, n)
+
+    # With wait=False the SUBACK is left to check_msg(), which returns
+    # 0x90 for it with rx_pid and rx_code set.
+    def subscribe(self, topic, qos=0, wait=True):
         assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
+        topic = _to_bytes(topic)
+        self._reserve(len(topic) + 8)
+        buf = self._wbuf
+        self._next_pid()
+        struct.pack_into("!BBHH", buf, 0, 0x82, 2 + 2 + len(topic) + 1, self.pid, len(topic))
+        n = 6 + len(topic)
+        buf[6:n] = topic
+        buf[n] = qos
+        #print(hex(n + 1), hexlify(buf[:n + 1], ":"))
+        self._write(buf, n + 1)
+        if not wait:
+            return self.pid
         while 1:
             op = self.wait_msg()
             if op == 0x90:
-                resp = self.sock.read(4)
-                #print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
+                assert self.rx_pid == self.pid
+                if self.rx_code == 0x80:
+                    raise MQTTException(self.rx_code)
                 return
 
     # Wait for a single incoming MQTT message and process it.
@@ -168,40 +452,26 @@ class MQTTClient:
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
-            return None
-        op = res[0]
-        if op & 0xf0 != 0x30:
-            return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
-        if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
-        if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
-        elif op & 6 == 4:
-            assert 0
-
-    # Checks whether a pending message from server is available.
-    # If not, returns immediately with None. Otherwise, does
-    # the same processing as wait_msg.
+        while 1:
+            pkt = self._next_packet()
+            if pkt is not None:
+                return self._process(*pkt)
+            if not self._fill():
+                self._rpoll.poll(-1)
+
+    # Processes every message the server has sent so far without
+    # blocking, then pings or detects a silent broker as the keepalive
+    # asks for. Packets that are only partially received stay in the
+    # buffer until the next call. Returns the type of the last
+    # non-PUBLISH packet handled, or None.
     def check_msg(self):
-        self.sock.setblocking(False)
-        return self.wait_msg()
\ No newline at end of file
+        res = None
+        while 1:
+            pkt = self._next_packet()
+            if pkt is not None:
+                op = self._process(*pkt)
+                if op is not None:
+                    res = op
+            elif not self._fill():
+                self._keepalive()
+                return res
@@ -1,55 +1,209 @@
+import os
 import json
 import time
+import struct
+import binascii
 
 from pump import Pump
 from regulator import Regulator
+import log
+
+logger = log.get_logger("state")
+
+FILES = ("state0.bin", "state1.bin")
+LEGACY_FILE = "state.json"
+MAGIC = b"PS"
+FILE_HEADER = "<2sBB"  # magic, format version, number of fields in each record
+FILE_HEADER_SIZE = 4
+FORMAT_VERSION = 1
+
+# name, struct code, default and the longest a change may wait for a save
+# in ms. The valve position changes all the time, the rest is set by hand.
+# New fields go last so records written by older firmware still load.
+FIELDS = (
+    ("valve_position", "d", 0, 600000),
+    ("pump_status", "B", Pump.ON, 10000),
+    ("regulator_mode", "B", Regulator.MANUAL, 10000),
+    ("curve_gain", "d", 1.0, 10000),
+    ("base_temp", "d", 30.0, 10000),
+    ("proportional_gain", "d", 1.0, 10000),
+    ("regulator_algorithm", "B", Regulator.P, 10000),
+    ("integral_time", "d", 300.0, 10000),
+    ("derivative_time", "d", 0.0, 10000),
+    ("feed_forward_gain", "d", 2.0, 10000),
+    ("valve_stroke_time", "d", 150.0, 10000),
+    ("valve_position_error", "d", 0.0, 600000),
+    ("adjustment_interval", "H", 300, 10000),
+    ("adjustment_threshold", "d", 3.0, 10000),
+    ("autotune_process_gain", "d", 0.0, 10000),
+    ("autotune_dead_time", "d", 0.0, 10000),
+    ("autotune_time_constant", "d", 0.0, 10000),
+)
+
+# Events whose name differs from the field they update
+EVENT_FIELDS = {"offset": "base_temp"}
+
+# Fields stored as an index into their allowed values
+ENUMS = {
+    "pump_status": (Pump.ON, Pump.OFF, Pump.UNKNOWN),
+    "regulator_mode": (Regulator.MANUAL, Regulator.AUTOMATIC),
+    "regulator_algorithm": Regulator.ALGORITHMS,
+}
+
+
+def _record_format(count):
+    return "<L" + "".join(field[1] for field in FIELDS[:count])  # seq, values
+
 
 class PersistentState:
-    def __init__(self):
-        self.state = {
-            'valve_position': 0,
-            'pump_status': Pump.ON,
-            'regulator_mode': Regulator.MANUAL,
-            'curve_gain': 1.0,
-            'base_temp': 30.0,
-            'proportional_gain': 1.0
-        }
-        self.save_time = time.ticks_ms()
-        self.has_changes = False
-
-    def update(self, system):
-
-        new_state = {
-            'valve_position': system.valve.position,
-            'pump_status': system.pump.status,
-            'regulator_mode': system.regulator.mode,
-            'curve_gain': system.regulator.gain,
-            'base_temp': system.regulator.offset,
-            'proportional_gain': system.regulator.proportional_gain
-        }
-
-        self.has_changes = self.has_changes or (new_state != self.state)
-        self.state = new_state
-
-        # save at most once every 10 minutes
-        if ( self.has_changes
-             and time.ticks_diff(time.ticks_ms(), self.save_time) > 600000):
+    """ Log-structured store of the controller state. Every save appends a
+    fixed-size record with a sequence number and a CRC to one of two files.
+    When that file is full the current state is written as the first record
+    of the other file, which then takes over, so the newest good record
+    always survives a power cut in the middle of a write. `load()` picks the
+    valid record with the highest sequence number.
+
+    Fields follow the change events of the system, see `on_event`. Each
+    changed field sets how long the save may wait, so valve movements are
+    batched while a new setting is stored within seconds. """
+
+    def __init__(self, records_per_file=128):
+        self.records_per_file = records_per_file
+        self.state = {}
+        self._index = {}
+        for index, (name, _, default, _) in enumerate(FIELDS):
+            self.state[name] = default
+            self._index[name] = index
+        self.dirty = 0  # Bit per field index changed since the last save
+        self._save_at = None  # ticks_ms when the pending changes are due
+        self.seq = 0
+        self._file = 0
+        self._count = records_per_file  # Records in the active file, full starts a new one
+        self._format = _record_format(len(FIELDS))
+        self._record = bytearray(struct.calcsize(self._format) + 4)
+
+    def set(self, name, value):
+        if self.state[name] == value:
+            return
+        self.state[name] = value
+        index = self._index[name]
+        self.dirty |= 1 << index
+        due = time.ticks_add(time.ticks_ms(), FIELDS[index][3])
+        if self._save_at is None or time.ticks_diff(due, self._save_at) < 0:
+            self._save_at = due
+
+    def on_event(self, kind, name, value):
+        name = EVENT_FIELDS.get(name, name)
+        if name in self._index:
+            self.set(name, value)
+
+    def update(self):
+        """ Saves the pending changes once the first of them is due. """
+        if self._save_at is not None and time.ticks_diff(time.ticks_ms(), self._save_at) >= 0:
             self.save()
 
     def save(self):
+        if not self.dirty:
+            return
+        record = self._pack(self.seq + 1)
         try:
-            with open("state.json", "w", encoding="utf-8") as f:
-                json.dump(self.state, f)
-            self.save_time = time.ticks_ms()
-            self.has_changes = False
+            if self._count >= self.records_per_file:
+                self._start_file(1 - self._file, record)
+            else:
+                with open(FILES[self._file], "ab") as f:
+                    f.write(record)
+                self._count += 1
         except OSError as e:
-            print(f"Failed to save state: {e}")
+            logger.error("Failed to save state: %s", e)
+            return
+        self.seq += 1
+        self.dirty = 0
+        self._save_at = None
+
+    def _start_file(self, file, record):
+        # Compaction: the full state goes first in the other file, the old
+        # file is only given up once that record is on flash
+        with open(FILES[file], "wb") as f:
+            f.write(struct.pack(FILE_HEADER, MAGIC, FORMAT_VERSION, len(FIELDS)))
+            f.write(record)
+        self._file = file
+        self._count = 1
+
+    def _pack(self, seq):
+        values = [seq]
+        for name, _, _, _ in FIELDS:
+            value = self.state[name]
+            choices = ENUMS.get(name)
+            values.append(choices.index(value) if choices else value)
+        record = self._record
+        struct.pack_into(self._format, record, 0, *values)
+        struct.pack_into("<L", record, len(record) - 4, binascii.crc32(memoryview(record)[:-4]))
+        return record
 
     def load(self):
+        newest = None  # (seq, file, slot, slots in file, values)
+        for file in range(len(FILES)):
+            for found in self._records(file):
+                if newest is None or found[0] > newest[0]:
+                    newest = found
+        if newest is None:
+            self._load_legacy()
+            return
+        seq, file, slot, count, values = newest
+        for (name, _, _, _), value in zip(FIELDS, values):
+            choices = ENUMS.get(name)
+            if choices:
+                if value >= len(choices):
+                    continue
+                value = choices[value]
+            self.state[name] = value
+        self.seq = seq
+        self._file = file
+        # Append after the newest record only if it ended the file cleanly
+        # in the current format, otherwise move on to the other file
+        if slot + 1 == count and len(values) == len(FIELDS):
+            self._count = count
+        else:
+            self._count = self.records_per_file
+        logger.info("Loaded state record %d", seq)
+
+    def _records(self, file):
+        """ Yields (seq, file, slot, slots in file, values) for every
+        record in `file` with a good CRC. """
+        try:
+            size = os.stat(FILES[file])[6]
+            f = open(FILES[file], "rb")
+        except OSError:
+            return
+        with f:
+            header = f.read(FILE_HEADER_SIZE)
+            if len(header) != FILE_HEADER_SIZE:
+                return
+            magic, version, fields = struct.unpack(FILE_HEADER, header)
+            if magic != MAGIC or version != FORMAT_VERSION or not 0 < fields <= len(FIELDS):
+                return
+            record_format = _record_format(fields)
+            record = bytearray(struct.calcsize(record_format) + 4)
+            # A partial record at the end counts as a slot so nothing is
+            # appended behind it
+            count = -(-(size - FILE_HEADER_SIZE) // len(record))
+            for slot in range(count):
+                if f.readinto(record) != len(record):
+                    break
+                crc = struct.unpack_from("<L", record, len(record) - 4)[0]
+                if binascii.crc32(memoryview(record)[:-4]) != crc:
+                    continue
+                values = struct.unpack_from(record_format, record, 0)
+                yield values[0], file, slot, count, values[1:]
+
+    def _load_legacy(self):
         try:
-            with open("state.json", "r", encoding="utf-8") as f:
-                self.state = json.load(f)
-                self.save_time = time.ticks_ms()
-                self.has_changes = False
+            with open(LEGACY_FILE, "r", encoding="utf-8") as f:
+                state = json.load(f)
         except (OSError, ValueError) as e:
-            print(f"Failed to load state, using defaults: {e}")
+            logger.warning("Failed to load state, using defaults: %s", e)
+            return
+        for name in self.state:
+            if name in state:
+                self.set(name, state[name])
+        logger.info("Loaded state from %s", LEGACY_FILE)
@@ -1,78 +1,35 @@
-import requests
-
-SHELLY_IP = "192.168.4.2"
-
-def get_shelly_status():
-    url = f"http://{SHELLY_IP}/rpc"
-    payload = {
-        "id": 1,
-        "method": "Shelly.GetStatus"
-    }
-    headers = {
-        "Content-Type": "application/json"
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    if response.status_code != 200:
-        raise Exception("Failed to read shelly status")
-    status_data = response.json()
-    response.close()
-    return status_data
-
-def set_shelly_power(on):
-    url = f"http://{SHELLY_IP}/rpc"
-    payload = {
-        "id": 1,
-        "method": "Switch.Set",
-        "params": {
-            "id": 0,
-            "on": on
-        }
-    }
-    headers = {
-        "Content-Type": "application/json"
-    }
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        result = response.json()
-        response.close()
-        return result
-    except Exception as e:
-        print(f"Error toggling power: {e}")
-        return None
+import time
+from events import PUMP
 
 
 class Pump:
-    def __init__(self, access_point):
+    def __init__(self, shelly):
         self.status = Pump.UNKNOWN
         self.wanted_state = Pump.UNKNOWN
         self.power = None
-        self.access_point = access_point
-
-    # Check if Shelly is connected to your AP
-    def is_shelly_connected_to_accesspoint(self):
-        try:
-            stations = self.access_point.status('stations')
-            return len(stations) > 0
-        except:
-            return False
+        self.updated = None  # ticks_ms of the Shelly reading behind status/power
+        self.shelly = shelly
+        self.events = None  # Set by SystemController
 
     def refresh(self):
-        if not self.is_shelly_connected_to_accesspoint():
+        if self.wanted_state != Pump.UNKNOWN:
+            self.shelly.request_output(self.wanted_state == Pump.ON)
+
+        output, power, updated = self.shelly.snapshot
+        self.updated = updated
+        status = self.status
+        previous_power = self.power
+        if updated is None or time.ticks_diff(time.ticks_ms(), updated) > Pump.STALE_TIME:
             self.status = Pump.UNKNOWN
             self.power = None
-
-        if self.wanted_state != Pump.UNKNOWN and self.wanted_state != self.status:
-            set_shelly_power(self.wanted_state == Pump.ON)
-
-        try:
-            status_data = get_shelly_status()
-            self.status = Pump.ON if status_data["result"]["switch:0"]["output"] else Pump.OFF
-            self.power = status_data["result"]["switch:0"]["aenergy"]['total']
-        except Exception as e:
-            print(e)
-            self.status = Pump.UNKNOWN
-            self.power = None
-
+        else:
+            self.status = Pump.ON if output else Pump.OFF
+            self.power = power
+        if self.events is not None:
+            if self.status != status:
+                self.events.emit(PUMP, "pump_status", self.status)
+            if self.power != previous_power:
+                self.events.emit(PUMP, "pump_power", self.power)
 
     def start(self):
         self.wanted_state = Pump.ON
@@ -84,3 +41,4 @@ class Pump:
 Pump.ON = "on"
 Pump.OFF = "off"
 Pump.UNKNOWN = "unknown"
+Pump.STALE_TIME = 10000  # ms before a Shelly reading is no longer trusted
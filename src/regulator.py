@@ -1,3 +1,9 @@
+from events import REGULATOR
+
+VALVE_MIN = 0
+VALVE_MAX = 150  # Valve end stops, see Valve
+DERIVATIVE_FILTER = 10  # The derivative is filtered with a time constant of derivative_time / 10
+
 
 class Regulator:
     def __init__(self, primary_supply_temp, secondary_supply_temp, ambient_temp, valve, pump):
@@ -7,6 +13,8 @@ class Regulator:
         self.valve = valve
         self.pump = pump
         self.mode = Regulator.MANUAL
+        self.hold = False  # Leave the valve alone, e.g. while Autotune drives it
+        self.events = None  # Set by SystemController
 
         # Configurable parameters
         self.adjustment_threshold = 3  # Minimum error output to trigger valve adjustment
@@ -14,6 +22,14 @@ class Regulator:
         self.adjustment_interval = 300  # 5 minutes = 300 seconds
         self.proportional_gain = 1.0
 
+        # PI/PID parameters, the output is valve run time in seconds
+        self.algorithm = Regulator.P
+        self.integral_time = 300.0  # s, 0 turns the integral part off
+        self.derivative_time = 0.0  # s, only used by PID
+        self.feed_forward_gain = 2.0  # s of valve run per °C the desired temperature moves
+        self.control_interval = 30  # s between PI/PID steps
+        self.min_pulse = 2  # s, smaller demands are collected until they add up
+
         # Heating curve parameters
         self.gain = 1.0   # Positive gain: higher = steeper heating curve
         self.offset = 30.0   # Base temperature when ambient is 0°C
@@ -21,16 +37,36 @@ class Regulator:
         # Internal state
         self.regulation_adjustment = 0
         self.last_adjustment_time = self.adjustment_interval
+        self._reset_pid()
 
+    def _reset_pid(self):
+        self._ticks = 0
+        self._last_error = None  # None until the first step after a reset
+        self._last_setpoint = 0.0
+        self._filtered = 0.0  # Low-pass filtered supply temperature
+        self._last_derivative = 0.0
+        self._pending = 0.0  # Valve run time asked for but not moved yet
 
     def desired_secondary_supply_temp(self):
         return -1 * self.gain * self.ambient_temp.value() + self.offset
 
     def regulate(self):
+        if self.algorithm != Regulator.P:
+            self._regulate_pid()
+            return
 
         # P-Regulation
+        if self.secondary_supply_temp.is_stale() or self.ambient_temp.is_stale():
+            # Hold the valve rather than act on old readings or the
+            # placeholders before the first conversions
+            if self.mode == Regulator.AUTOMATIC:
+                self.pump.start()
+            return
         error = self.desired_secondary_supply_temp() - self.secondary_supply_temp.value()
-        self.regulation_adjustment = self.proportional_gain * error
+        adjustment = self.proportional_gain * error
+        if adjustment != self.regulation_adjustment:
+            self.regulation_adjustment = adjustment
+            self._changed("regulation_adjustment", adjustment)
 
 
         if self.mode == Regulator.MANUAL:
@@ -38,6 +74,8 @@ class Regulator:
 
         # Keep pump running while in automatic mode
         self.pump.start()
+        if self.hold:
+            return
 
         self.last_adjustment_time += 1
         if self.last_adjustment_time <= self.adjustment_interval:
@@ -50,9 +88,125 @@ class Regulator:
                 min(self.regulation_adjustment, self.max_adjustment))
             self.valve.adjust(adjustment)
 
+    def _regulate_pid(self):
+        """ Velocity form PI/PID: every step computes the change of the
+        valve position, which suits a valve that is driven open and closed
+        rather than to a position. """
+        if self.mode == Regulator.MANUAL or self.hold:
+            # Start over on the next switch to automatic, so it is bumpless
+            self._last_error = None
+            if self.mode == Regulator.AUTOMATIC:
+                self.pump.start()
+            return
+
+        # Keep pump running while in automatic mode
+        self.pump.start()
+
+        self._ticks += 1
+        if self._ticks < self.control_interval:
+            return
+        self._ticks = 0
+        if self.secondary_supply_temp.is_stale() or self.ambient_temp.is_stale():
+            return  # Hold the valve rather than act on old readings
+
+        setpoint = self.desired_secondary_supply_temp()
+        measurement = self.secondary_supply_temp.value()
+        error = setpoint - measurement
+        if self._last_error is None:
+            self._last_error = error
+            self._last_setpoint = setpoint
+            self._filtered = measurement
+            self._last_derivative = 0.0
+            return
+
+        dt = self.control_interval
+        kp = self.proportional_gain
+        output = kp * (error - self._last_error)
+        if self.integral_time > 0:
+            output += kp * dt / self.integral_time * error
+        # The derivative is taken on the measurement, so a new desired
+        # temperature gives no kick
+        last_filtered = self._filtered
+        filter_time = self.derivative_time / DERIVATIVE_FILTER
+        self._filtered += dt / (filter_time + dt) * (measurement - last_filtered)
+        derivative = 0.0
+        if self.algorithm == Regulator.PID:
+            derivative = -kp * self.derivative_time * (self._filtered - last_filtered) / dt
+        output += derivative - self._last_derivative
+        self._last_derivative = derivative
+        output += self.feed_forward_gain * (setpoint - self._last_setpoint)
+        self._last_error = error
+        self._last_setpoint = setpoint
+
+        # Anti-windup: demand past the end stops is dropped instead of being
+        # collected. The rate limit only spreads the rest over more steps.
+        position = self.valve.position
+        pending = self._pending + output
+        pending = max(-self.valve.run_time(position - VALVE_MIN),
+                      min(pending, self.valve.run_time(VALVE_MAX - position)))
+        if (not self.valve.adjusting and self.valve.calibration is None
+                and abs(pending) >= self.min_pulse):
+            run = max(-self.max_adjustment, min(pending, self.max_adjustment))
+            if self.valve.adjust(run):
+                pending -= run  # Otherwise it is tried again on the next step
+        self._pending = pending
+
+        if output != self.regulation_adjustment:
+            self.regulation_adjustment = output
+            self._changed("regulation_adjustment", output)
+
 
     def set_mode(self, mode):
-        self.mode = mode
+        if mode != self.mode:
+            self.mode = mode
+            self._changed("regulator_mode", mode)
+
+    def set_algorithm(self, algorithm):
+        if algorithm != self.algorithm:
+            self.algorithm = algorithm
+            self._reset_pid()
+            self._changed("regulator_algorithm", algorithm)
+
+    def set_gain(self, gain):
+        self.gain = gain
+        self._changed("curve_gain", gain)
+
+    def set_offset(self, offset):
+        self.offset = offset
+        self._changed("offset", offset)
+
+    def set_proportional_gain(self, proportional_gain):
+        self.proportional_gain = proportional_gain
+        self._changed("proportional_gain", proportional_gain)
+
+    def set_adjustment_interval(self, adjustment_interval):
+        # At most what the uint16 field of the persistent state holds
+        self.adjustment_interval = max(1, min(65535, int(adjustment_interval)))
+        self._changed("adjustment_interval", self.adjustment_interval)
+
+    def set_adjustment_threshold(self, adjustment_threshold):
+        self.adjustment_threshold = max(0.0, adjustment_threshold)
+        self._changed("adjustment_threshold", self.adjustment_threshold)
+
+    def set_integral_time(self, integral_time):
+        self.integral_time = max(0.0, integral_time)
+        self._changed("integral_time", self.integral_time)
+
+    def set_derivative_time(self, derivative_time):
+        self.derivative_time = max(0.0, derivative_time)
+        self._changed("derivative_time", self.derivative_time)
+
+    def set_feed_forward_gain(self, feed_forward_gain):
+        self.feed_forward_gain = feed_forward_gain
+        self._changed("feed_forward_gain", feed_forward_gain)
+
+    def _changed(self, name, value):
+        if self.events is not None:
+            self.events.emit(REGULATOR, name, value)
 
 Regulator.MANUAL = "manual"
 Regulator.AUTOMATIC = "automatic"
+Regulator.P = "p"
+Regulator.PI = "pi"
+Regulator.PID = "pid"
+Regulator.ALGORITHMS = (Regulator.P, Regulator.PI, Regulator.PID)
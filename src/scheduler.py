@@ -0,0 +1,55 @@
+import time
+from metrics import metrics
+import log
+
+logger = log.get_logger("scheduler")
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+
+def sleep_ms(ms):
+    return asyncio.sleep(ms / 1000)
+
+
+class PeriodicTask:
+    """ Runs a plain function every `period` ms on the event loop. A run that
+    takes longer than `deadline` ms counts as an overrun. Missed periods are
+    skipped rather than run back to back. """
+
+    def __init__(self, name, period, function, deadline=None):
+        self.name = name
+        self.period = period
+        self.function = function
+        self.deadline = period if deadline is None else deadline
+        self.histogram = metrics.histogram(name)
+        self.last_duration = 0  # ms
+        self.overruns = 0
+        self.errors = 0
+
+    async def run(self):
+        next_time = time.ticks_ms()
+        while True:
+            start = time.ticks_us()
+            try:
+                self.function()
+            except Exception as e:
+                self.errors += 1
+                metrics.inc("task_errors")
+                logger.error("Task %s failed: %s", self.name, e)
+            duration = time.ticks_diff(time.ticks_us(), start)
+            self.histogram.observe(duration)
+            self.last_duration = duration // 1000
+            if self.last_duration > self.deadline:
+                self.overruns += 1
+                metrics.inc("overruns")
+                logger.warning("Task %s overran: %d ms", self.name, self.last_duration)
+
+            next_time = time.ticks_add(next_time, self.period)
+            delay = time.ticks_diff(next_time, time.ticks_ms())
+            if delay < 0:
+                next_time = time.ticks_ms()
+                delay = 0
+            await sleep_ms(delay)
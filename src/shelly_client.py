@@ -0,0 +1,135 @@
+import json
+import time
+from scheduler import asyncio, sleep_ms
+from metrics import metrics
+import log
+
+logger = log.get_logger("shelly")
+
+SHELLY_IP = "192.168.4.2"
+
+
+class ShellyClient:
+    """ Polls the Shelly plug from its own task over one keep-alive
+    connection. The control loop only reads `snapshot` and posts the wanted
+    output with `request_output()`, so it never waits on the plug. """
+
+    def __init__(self, host=SHELLY_IP, port=80, timeout=2,
+                 poll_interval=2000, command_interval=1000, max_command_interval=30000):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.command_interval = command_interval
+        self.max_command_interval = max_command_interval
+
+        # (output, energy total, ticks_ms of the reading), replaced as a whole
+        self.snapshot = (None, None, None)
+        self.failures = 0
+
+        self._wanted = None
+        self._command_time = None
+        self._command_backoff = command_interval
+        self._poll_time = None
+        self._reader = None
+        self._writer = None
+
+    def request_output(self, on):
+        if on != self._wanted:
+            self._wanted = on
+            self._command_time = None
+            self._command_backoff = self.command_interval
+
+    async def run(self):
+        while True:
+            await self.step()
+            await sleep_ms(100)
+
+    async def step(self):
+        now = time.ticks_ms()
+        output = self.snapshot[0]
+        if (self._wanted is not None and self._wanted != output
+                and (self._command_time is None
+                     or time.ticks_diff(now, self._command_time) >= self._command_backoff)):
+            self._command_time = now
+            try:
+                await self.set_switch(self._wanted)
+                self._command_backoff = self.command_interval
+                self._poll_time = None  # Read back the new state right away
+            except Exception as e:
+                metrics.inc("shelly_failures")
+                logger.error("Error setting shelly output: %s", e)
+                self._command_backoff = min(self._command_backoff * 2, self.max_command_interval)
+
+        if self._poll_time is None or time.ticks_diff(now, self._poll_time) >= self.poll_interval:
+            self._poll_time = now
+            try:
+                status = await self.get_switch_status()
+                self.snapshot = (status["output"], status["aenergy"]["total"], time.ticks_ms())
+                self.failures = 0
+            except Exception as e:
+                metrics.inc("shelly_failures")
+                logger.warning("Error reading shelly status: %s", e)
+                self.failures += 1
+
+    async def get_switch_status(self):
+        return await self._rpc("Switch.GetStatus?id=0")
+
+    async def set_switch(self, on):
+        return await self._rpc("Switch.Set?id=0&on=" + ("true" if on else "false"))
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+
+    async def _close(self):
+        writer = self._writer
+        self._reader = None
+        self._writer = None
+        if writer is not None:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _rpc(self, method):
+        for attempt in range(2):
+            # A kept-alive connection may have been dropped by the plug,
+            # so retry once on a fresh one before giving up.
+            reused = self._writer is not None
+            if not reused:
+                await self._connect()
+            try:
+                return await asyncio.wait_for(self._request(method), self.timeout)
+            except Exception:
+                await self._close()
+                if not reused or attempt:
+                    raise
+
+    async def _request(self, method):
+        self._writer.write(
+            f"GET /rpc/{method} HTTP/1.1\r\nHost: {self.host}\r\nConnection: keep-alive\r\n\r\n".encode())
+        await self._writer.drain()
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise OSError("connection closed")
+        status_code = int(status_line.split()[1])
+        length = 0
+        keep_alive = True
+        while True:
+            line = await self._reader.readline()
+            if not line or line == b"\r\n":
+                break
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                length = int(value)
+            elif name == b"connection" and value.strip().lower() == b"close":
+                keep_alive = False
+        body = await self._reader.readexactly(length) if length else b""
+        if not keep_alive:
+            await self._close()
+        if status_code != 200:
+            raise Exception(f"Shelly responded {status_code}")
+        return json.loads(body)
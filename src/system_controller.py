@@ -1,3 +1,7 @@
+from events import EventBus
+from autotune import Autotune
+
+
 class SystemController:
     def __init__(self, regulator, pump, valve, ambient_temp, primary_supply_temp,
                  primary_return_temp, secondary_supply_temp, secondary_return_temp):
@@ -9,3 +13,11 @@ class SystemController:
         self.primary_return_temp = primary_return_temp
         self.secondary_supply_temp = secondary_supply_temp
         self.secondary_return_temp = secondary_return_temp
+        self.autotune = Autotune(regulator)
+
+        # Components emit their changes here, see events.py
+        self.events = EventBus()
+        regulator.events = self.events
+        pump.events = self.events
+        valve.events = self.events
+        self.autotune.events = self.events
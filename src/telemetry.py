@@ -0,0 +1,138 @@
+import time
+from telemetry_frame import HEADER_SIZE
+
+
+class TelemetryTopic:
+    def __init__(self, topic, getter, deadband=0, min_interval=0, max_interval=60000, retain=False,
+                 qos=0):
+        self.topic = topic
+        self.getter = getter
+        self.deadband = deadband  # Smallest change that is worth publishing
+        self.min_interval = min_interval  # ms, rate limit for changing values
+        self.max_interval = max_interval  # ms, heartbeat for unchanged values
+        self.retain = retain
+        self.qos = qos  # 1 to have the broker acknowledge it
+        self.last_value = None
+        self.last_time = None
+        self.changed = True  # An event said the value moved since it was checked
+
+    def is_due(self, value, now):
+        if self.last_time is None:
+            return True
+        elapsed = time.ticks_diff(now, self.last_time)
+        if elapsed < self.min_interval:
+            return False
+        if elapsed >= self.max_interval:
+            return True
+        if value == self.last_value:
+            return False
+        if (self.deadband
+                and isinstance(value, (int, float))
+                and isinstance(self.last_value, (int, float))):
+            return abs(value - self.last_value) >= self.deadband
+        return True
+
+
+class TelemetryPublisher:
+    """ Publishes a topic only when its value moved by more than its deadband,
+    or when its heartbeat interval has passed. Topics are named after the
+    change events, see `on_event`, and only a changed topic or one with its
+    heartbeat due is read on a publish. QoS 0 topics of a cycle go out in a
+    single write, QoS 1 topics one by one as the in-flight window allows. """
+
+    def __init__(self, client, topic_prefix):
+        self.client = client
+        self.topic_prefix = topic_prefix
+        self.topics = []
+        self._by_name = {}
+
+    def add(self, name, getter, **kwargs):
+        topic = TelemetryTopic(f"{self.topic_prefix}/{name}", getter, **kwargs)
+        self.topics.append(topic)
+        self._by_name[name] = topic
+
+    def on_event(self, kind, name, value):
+        topic = self._by_name.get(name)
+        if topic is not None:
+            topic.changed = True
+
+    def reset(self):
+        # Send everything again, e.g. after a reconnect
+        for topic in self.topics:
+            topic.last_time = None
+            topic.changed = True
+
+    def publish(self):
+        now = time.ticks_ms()
+        batch = []
+        due = []
+        for topic in self.topics:
+            if not topic.changed and time.ticks_diff(now, topic.last_time) < topic.max_interval:
+                continue
+            value = topic.getter()
+            if topic.is_due(value, now):
+                if topic.qos:
+                    # Not acknowledged yet, but mqttsimple sends it again
+                    # after a reconnect. A full window leaves it changed.
+                    if self.client.publish(topic.topic, str(value), topic.retain, 1) is not None:
+                        topic.last_value = value
+                        topic.last_time = now
+                        topic.changed = False
+                    continue
+                batch.append((topic.topic, str(value), topic.retain))
+                due.append((topic, value))
+            elif time.ticks_diff(now, topic.last_time) >= topic.min_interval:
+                topic.changed = False  # Within the deadband, wait for the next change
+        if not batch:
+            return
+        # One socket write for the whole cycle
+        self.client.publish_many(batch)
+        for topic, value in due:
+            topic.last_value = value
+            topic.last_time = now
+            topic.changed = False
+
+
+class FramePublisher:
+    """ Publishes the whole snapshot as one binary frame, see telemetry_frame,
+    instead of a topic per value. After a change event a frame goes out if
+    any value moved by one step of its scale, at most every `min_interval`
+    ms, and otherwise every `max_interval` ms. Frames are QoS 0, a lost one
+    is replaced by the next. """
+
+    def __init__(self, client, topic, encoder, timesync, min_interval=5000, max_interval=60000):
+        self.client = client
+        self.topic = topic
+        self.encoder = encoder
+        self.timesync = timesync
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.seq = 0
+        self.last_time = None
+        self.last_values = None  # Fields of the last frame sent
+        self.changed = True
+
+    def on_event(self, kind, name, value):
+        self.changed = True
+
+    def reset(self):
+        self.last_time = None
+        self.changed = True
+
+    def publish(self):
+        now = time.ticks_ms()
+        heartbeat = True
+        if self.last_time is not None:
+            elapsed = time.ticks_diff(now, self.last_time)
+            heartbeat = elapsed >= self.max_interval
+            if elapsed < self.min_interval or (not self.changed and not heartbeat):
+                return
+        frame = self.encoder.pack(self.seq, self.timesync.epoch(now))
+        values = frame[HEADER_SIZE:]
+        self.changed = False
+        if not heartbeat and values == self.last_values:
+            return
+        self.client.publish(self.topic, frame)
+        self.seq = (self.seq + 1) & 0xffff
+        self.last_time = now
+        self.last_values = values
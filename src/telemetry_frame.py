@@ -0,0 +1,111 @@
+""" Compact binary telemetry frame, one PUBLISH per snapshot of the system.
+
+Layout, little endian: a header of format version (B), schema id (B),
+sequence number (H, wraps) and Unix time (L, 0 while the clock is not
+set), then the fields of the schema in order. Numbers are scaled
+integers, e.g. centi-degrees, and enums are indexes into their names.
+Missing values, e.g. a stale sensor, are the lowest int16 or the highest
+unsigned value of the field.
+
+The decoder only needs struct, so consumers can use this module as it is:
+
+    import telemetry_frame
+    snapshot = telemetry_frame.decode(message.payload)
+
+or `python telemetry_frame.py <hex>` to decode a frame from the command
+line.
+"""
+import struct
+
+FRAME_VERSION = 1
+HEADER = "<BBHL"  # version, schema id, sequence, time
+HEADER_SIZE = 8
+
+PUMP_STATES = ("on", "off", "unknown")  # Pump.ON, Pump.OFF, Pump.UNKNOWN
+MODES = ("manual", "automatic")  # Regulator.MANUAL, Regulator.AUTOMATIC
+ALGORITHMS = ("p", "pi", "pid")  # Regulator.ALGORITHMS
+
+# Schema id to its fields: name, struct code and a scale for numbers or
+# the names for enums. New fields need a new schema id.
+SCHEMAS = {
+    1: (
+        ("ambient_temp", "h", 100),
+        ("primary_supply_temp", "h", 100),
+        ("primary_return_temp", "h", 100),
+        ("secondary_supply_temp", "h", 100),
+        ("secondary_return_temp", "h", 100),
+        ("desired_temp", "h", 100),
+        ("valve_position", "h", 100),
+        ("valve_position_error", "h", 100),
+        ("regulation_adjustment", "h", 100),
+        ("pump_energy", "L", 10),  # Wh, total of the Shelly
+        ("pump_status", "B", PUMP_STATES),
+        ("regulator_mode", "B", MODES),
+        ("regulator_algorithm", "B", ALGORITHMS),
+    ),
+}
+SCHEMA = 1  # Sent by this firmware
+
+MISSING = {"h": -32768, "H": 0xffff, "L": 0xffffffff, "B": 0xff}
+LIMITS = {"h": (-32767, 32767), "H": (0, 0xfffe), "L": (0, 0xfffffffe), "B": (0, 0xfe)}
+
+
+def _format(schema):
+    return HEADER + "".join(field[1] for field in SCHEMAS[schema])
+
+
+class FrameEncoder:
+    """ Packs the values of `getters`, field name to a callable, into a
+    preallocated frame. A getter returns None for a missing value. """
+
+    def __init__(self, getters, schema=SCHEMA):
+        self.schema = schema
+        self.fields = SCHEMAS[schema]
+        self.getters = [getters[name] for name, _, _ in self.fields]
+        self._format = _format(schema)
+        self._frame = bytearray(struct.calcsize(self._format))
+        self._values = [0] * (len(self.fields) + 4)
+
+    def pack(self, seq, t):
+        values = self._values
+        values[0] = FRAME_VERSION
+        values[1] = self.schema
+        values[2] = seq & 0xffff
+        values[3] = t or 0
+        for i, (name, code, scale) in enumerate(self.fields):
+            value = self.getters[i]()
+            if value is None:
+                value = MISSING[code]
+            elif isinstance(scale, tuple):
+                value = scale.index(value) if value in scale else MISSING[code]
+            else:
+                low, high = LIMITS[code]
+                value = max(low, min(high, int(round(value * scale))))
+            values[i + 4] = value
+        struct.pack_into(self._format, self._frame, 0, *values)
+        return self._frame
+
+
+def decode(data):
+    """ Dict of the header and the fields of a frame, None for missing
+    values. Raises ValueError for an unknown version or schema. """
+    version, schema, seq, t = struct.unpack_from(HEADER, data, 0)
+    if version != FRAME_VERSION or schema not in SCHEMAS:
+        raise ValueError("Unknown frame version %d schema %d" % (version, schema))
+    values = struct.unpack_from(_format(schema), data, 0)
+    snapshot = {"version": version, "schema": schema, "seq": seq, "time": t or None}
+    for (name, code, scale), value in zip(SCHEMAS[schema], values[4:]):
+        if value == MISSING[code]:
+            value = None
+        elif isinstance(scale, tuple):
+            value = scale[value] if value < len(scale) else None
+        else:
+            value = value / scale
+        snapshot[name] = value
+    return snapshot
+
+
+if __name__ == "__main__":
+    import sys
+    import json
+    print(json.dumps(decode(bytes.fromhex(sys.argv[1])), indent=2))
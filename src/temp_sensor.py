@@ -1,6 +1,19 @@
+import time
+import json
+import binascii
 from machine import Pin
 import ds18x20
 import onewire
+from metrics import metrics
+from events import SENSOR
+import log
+
+logger = log.get_logger("sensors")
+
+# Worst case DS18B20 conversion time in ms per resolution in bits
+CONVERSION_TIME = {9: 94, 10: 188, 11: 375, 12: 750}
+
+CONVERT_T = 0x44
 
 
 class TempSensor():
@@ -12,36 +25,199 @@ class TempSensor():
     def value(self):
         return self._temp_sensor_array.temperatures[self._index]
 
+    def timestamp(self):
+        """ ticks_ms of the last good reading, None before the first one. """
+        return self._temp_sensor_array.timestamps[self._index]
+
+    def is_stale(self):
+        return self._temp_sensor_array.stale[self._index]
+
     def name(self):
         return self._name
 
+
+class _Channel:
+    def __init__(self, name):
+        self.name = name
+        self.bus = None
+        self.rom = None  # None until a probe is bound to the name
+        self.resolution = 12
+        self.period = 1000  # ms between samples
+        self.next_sample = time.ticks_ms()
+        self.ready_at = None  # ticks_ms when the running conversion is done
+
+
 class TempSensors():
-    def __init__(self, *ports):
-        self._ds_array = []
-        self._roms_array = []
+    """ Runs conversions and reads as a pipeline. Every sensor is converted
+    on its own with Match ROM and read once its conversion time has passed,
+    so sensors with different resolution and sampling period can share a
+    bus. `scan()` does at most one bus transaction per bus per call and
+    should be called often, e.g. every 100 ms.
 
+    Probes are bound to names by ROM code. The binding is stored in
+    `binding_file` and loaded at start up, so no bus enumeration is needed
+    before control starts. `rescan()` enumerates one bus per call in the
+    background to pick up new or replaced probes. """
+
+    def __init__(self, ports, names, binding_file="sensors.json"):
+        self._ds_array = []
         for port in ports:
             one_wire = onewire.OneWire(Pin(port))
-            ds_array = ds18x20.DS18X20(one_wire)
-            self._ds_array.append(ds_array)
-            self._roms_array.append(ds_array.scan())
+            self._ds_array.append(ds18x20.DS18X20(one_wire))
+
+        self._channels = [_Channel(name) for name in names]
+        self._index = {}
+        for index, name in enumerate(names):
+            self._index[name] = index
+        self._binding_file = binding_file
+        self._load_binding()
+
+        count = len(self._channels)
+        self.temperatures = [25] * count
+        self.timestamps = [None] * count
+        self.stale = [True] * count
+        self._busy = bytearray(len(ports))
+        self._next_channel = 0
+        self._next_rescan = 0
+        self.events = None  # SystemController.events, for SENSOR events
+
+    def _load_binding(self):
+        try:
+            with open(self._binding_file, "r") as f:
+                binding = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("No sensor binding, waiting for rescan: %s", e)
+            return
+        for name, (bus, rom) in binding.items():
+            index = self._index.get(name)
+            if index is not None and bus < len(self._ds_array):
+                self._channels[index].bus = bus
+                self._channels[index].rom = binascii.unhexlify(rom)
 
-        self.temperatures = [25] * sum(len(roms) for roms in self._roms_array)
+    def _save_binding(self):
+        binding = {}
+        for channel in self._channels:
+            if channel.rom is not None:
+                binding[channel.name] = [channel.bus, binascii.hexlify(channel.rom).decode()]
+        try:
+            with open(self._binding_file, "w") as f:
+                json.dump(binding, f)
+        except OSError as e:
+            logger.error("Failed to save sensor binding: %s", e)
 
-        for ds in self._ds_array:
-            ds.convert_temp()
+    def rescan(self):
+        """ Enumerate the next bus and bind probes that are not bound yet.
+        A new probe on a bus where a bound probe has gone missing replaces
+        it, otherwise new probes go to the unbound names in order. """
+        bus = self._next_rescan
+        self._next_rescan = (bus + 1) % len(self._ds_array)
+        try:
+            roms = [bytes(rom) for rom in self._ds_array[bus].scan()]
+        except Exception as e:
+            logger.error("Error scanning bus %d: %s", bus, e)
+            return
 
-    def get_sensor(self, index, name):
+        bound = [channel.rom for channel in self._channels if channel.rom is not None]
+        new_roms = [rom for rom in roms if rom not in bound]
+        if not new_roms:
+            return
+        missing = [channel for channel in self._channels
+                   if channel.rom is not None and channel.bus == bus and channel.rom not in roms]
+        unbound = [channel for channel in self._channels if channel.rom is None]
+        for channel in missing + unbound:
+            if not new_roms:
+                break
+            rom = new_roms.pop(0)
+            if channel.rom is None:
+                logger.info("Bound %s to %s", channel.name, binascii.hexlify(rom))
+            else:
+                logger.warning("Replaced %s probe %s with %s", channel.name,
+                               binascii.hexlify(channel.rom), binascii.hexlify(rom))
+            channel.bus = bus
+            channel.rom = rom
+            channel.ready_at = None
+            channel.next_sample = time.ticks_ms()
+            self._write_resolution(channel)
+        self._save_binding()
+
+    def get_sensor(self, name, resolution=12, period=1000):
+        index = self._index[name]
+        channel = self._channels[index]
+        channel.period = period
+        if resolution != channel.resolution:
+            channel.resolution = resolution
+            if channel.rom is not None:
+                self._write_resolution(channel)
         return TempSensor(self, index, name)
 
+    def _write_resolution(self, channel):
+        try:
+            # TH, TL and the configuration register with R1 R0 in bits 6-5
+            config = bytearray((0, 0, (channel.resolution - 9) << 5 | 0x1f))
+            self._ds_array[channel.bus].write_scratch(channel.rom, config)
+        except Exception as e:
+            logger.error("Failed to set resolution of %s: %s", channel.name, e)
+
     def scan(self):
+        now = time.ticks_ms()
+        busy = self._busy
+        for bus in range(len(busy)):
+            busy[bus] = False
+        count = len(self._channels)
+        # Rotate the starting point so every sensor gets a turn on a busy bus
+        start = self._next_channel
+        self._next_channel = (start + 1) % count if count else 0
+        for n in range(count):
+            index = (start + n) % count
+            channel = self._channels[index]
+            if channel.rom is None or busy[channel.bus]:
+                continue
+            if channel.ready_at is not None:
+                if time.ticks_diff(now, channel.ready_at) >= 0:
+                    busy[channel.bus] = True
+                    channel.ready_at = None
+                    self._read(index, channel)
+            elif time.ticks_diff(now, channel.next_sample) >= 0:
+                busy[channel.bus] = True
+                channel.next_sample = time.ticks_add(channel.next_sample, channel.period)
+                if time.ticks_diff(now, channel.next_sample) > 0:
+                    channel.next_sample = time.ticks_add(now, channel.period)
+                self._convert(index, channel, now)
+
+    def _convert(self, index, channel, now):
         try:
-            sensor_index = 0
-            for ids, ds in enumerate(self._ds_array):
-                for roms in self._roms_array[ids]:
-                    self.temperatures[sensor_index] = ds.read_temp(roms)
-                    sensor_index = sensor_index + 1
-            for ds in self._ds_array:
-                ds.convert_temp()
+            ow = self._ds_array[channel.bus].ow
+            ow.reset(True)
+            ow.select_rom(channel.rom)
+            ow.writebyte(CONVERT_T)
+            channel.ready_at = time.ticks_add(now, CONVERSION_TIME[channel.resolution])
         except Exception as e:
-            print(f"Error reading temperature sensors: {e}")
+            metrics.inc("sensor_read_errors")
+            logger.error("Error starting conversion: %s", e)
+            # No new reading is coming, e.g. a dead bus, so stop trusting the last one
+            self._set_stale(index, channel)
+
+    def _read(self, index, channel):
+        try:
+            value = self._ds_array[channel.bus].read_temp(channel.rom)
+            if value is None:
+                raise ValueError("no reading")
+        except Exception as e:
+            # Typically a CRC error, keep the last good value but flag it
+            metrics.inc("sensor_read_errors")
+            logger.warning("Error reading temperature sensor %d: %s", index, e)
+            self._set_stale(index, channel)
+            return
+        self.temperatures[index] = value
+        self.timestamps[index] = time.ticks_ms()
+        self.stale[index] = False
+        self._emit(channel, value)
+
+    def _set_stale(self, index, channel):
+        if not self.stale[index]:
+            self.stale[index] = True
+            self._emit(channel, self.temperatures[index])
+
+    def _emit(self, channel, value):
+        if self.events is not None:
+            self.events.emit(SENSOR, channel.name, value)
@@ -0,0 +1,126 @@
+import time
+import struct
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+from machine import RTC
+from connection import Backoff
+import log
+
+logger = log.get_logger("time")
+
+NTP_PORT = 123
+NTP_TIMEOUT = 2000  # ms to wait for the reply
+# Seconds from the NTP epoch (1900) to the time.time() epoch of the port,
+# 2000 on the ESP32 and 1970 elsewhere
+EPOCH_2000 = time.gmtime(0)[0] == 2000
+NTP_DELTA = 3155673600 if EPOCH_2000 else 2208988800
+UNIX_OFFSET = 946684800 if EPOCH_2000 else 0  # time.time() to Unix time
+
+
+class TimeSync:
+    """ Keeps a mapping from ticks_ms to Unix time. With an NTP `host` a
+    query is sent every `interval` ms and the reply picked up on a later
+    `run()`, so nothing waits on the network. The reply also sets the RTC,
+    which time.time() follows. Without a host the RTC is trusted as it is.
+
+    Samples stamped with ticks_ms before the first sync, e.g. after a
+    reboot while WiFi was down, get their time once a sync succeeds, as
+    long as they are less than half the ticks period (6 days) old. """
+
+    def __init__(self, wifi_client, host="pool.ntp.org", interval=3600000):
+        self.wifi_client = wifi_client
+        self.host = host
+        self.interval = interval
+        self.synced = not host
+        self.backoff = Backoff(initial=10000, maximum=interval)
+        self._base_ticks = time.ticks_ms()  # ticks_ms at _base_time
+        self._base_time = (int(time.time()) + UNIX_OFFSET) * 1000  # Unix ms
+        self._addr = None
+        self._sock = None
+        self._sent = None  # ticks_ms the running query was sent
+        self._next = None  # ticks_ms of the next query, None for at once
+        self._packet = bytearray(48)
+
+    def epoch(self, ticks):
+        """ Unix time in s of a ticks_ms value, None before the first sync. """
+        if not self.synced:
+            return None
+        if not self.host:
+            # The RTC is the reference, follow it as it is set
+            self._base_ticks = time.ticks_ms()
+            self._base_time = (int(time.time()) + UNIX_OFFSET) * 1000
+        return (self._base_time + time.ticks_diff(ticks, self._base_ticks)) // 1000
+
+    def run(self):
+        """ Called every second. """
+        if not self.host:
+            return
+        now = time.ticks_ms()
+        if self._sent is not None:
+            self._receive(now)
+        elif ((self._next is None or time.ticks_diff(now, self._next) >= 0)
+              and self.wifi_client.isconnected()):
+            self._send(now)
+
+    def _send(self, now):
+        try:
+            if self._addr is None:
+                self._addr = socket.getaddrinfo(self.host, NTP_PORT)[0][-1]
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.setblocking(False)
+            packet = self._packet
+            for i in range(len(packet)):
+                packet[i] = 0
+            packet[0] = 0x1b  # Version 3, client mode
+            self._sock.sendto(packet, self._addr)
+            self._sent = now
+        except OSError as e:
+            self._fail("NTP %s" % e, now)
+
+    def _receive(self, now):
+        try:
+            reply = self._sock.recv(48)
+        except OSError:
+            reply = None  # Nothing yet
+        if not reply:
+            if time.ticks_diff(now, self._sent) >= NTP_TIMEOUT:
+                self._fail("NTP timeout", now)
+            return
+        self._close()
+        if len(reply) < 48:
+            self._fail("NTP short reply", now)
+            return
+        seconds, fraction = struct.unpack_from("!II", reply, 40)
+        if seconds == 0:
+            self._fail("NTP empty reply", now)
+            return
+        # The server read its clock about half way through the round trip
+        self._base_ticks = time.ticks_add(self._sent, time.ticks_diff(now, self._sent) // 2)
+        local = seconds - NTP_DELTA
+        self._base_time = (local + UNIX_OFFSET) * 1000 + (fraction * 1000 >> 32)
+        tm = time.gmtime(local)
+        RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+        if not self.synced:
+            logger.info("Time synced")
+        self.synced = True
+        self._sent = None
+        self.backoff.reset()
+        self._next = time.ticks_add(now, self.interval)
+
+    def _fail(self, error, now):
+        self._close()
+        self._sent = None
+        self._addr = None
+        self.backoff.fail(now)
+        self._next = self.backoff.next
+        logger.warning("%s, next attempt in %d s", error, self.backoff.remaining(now) // 1000)
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
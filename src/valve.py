@@ -1,47 +1,212 @@
+import time
+from machine import Pin, Timer
+from events import VALVE
+import log
+
+logger = log.get_logger("valve")
+
+FULL = 150  # Position at the open end stop, 0 is the closed one
+HOMING_MARGIN = 5  # s to run on against an end stop to be sure it is reached
+PULSE_ERROR = 0.2  # Position error added per pulse for actuator start and stop
+MOVE_ERROR = 0.02  # Position error added per position unit moved
+
+
 class Valve:
-    def __init__(self, pin_open, pin_close):
+    """ Three-point valve actuator on two active low relays. A move is one
+    pulse on the open or close relay, started by `open()` or `close()` and
+    ended by a one-shot timer, so the relay is released on time even when
+    the main loop is late. `position` runs from 0 (closed) to 150 (open) and
+    follows the time the relay was actually energized, scaled by the full
+    stroke time of the actuator.
+
+    Dead reckoning drifts, so `position_error` estimates how far off the
+    position may be. Any move that reaches an end stop runs on past it by
+    more than that error, which re-homes the position. `calibrate()` homes
+    at the closed end and returns to the previous position. With optional
+    end stop switches it also measures the stroke time on the way. """
+
+    def __init__(self, pin_open, pin_close, timer, end_stops=None):
         self.pin_open = pin_open
         self.pin_close = pin_close
+        self.timer = timer  # One-shot timer that ends the pulses
         self.opening = False
         self.closing = False
-        self.adjusting = 0
+        self.adjusting = 0  # Whole seconds left of the running pulse
         self.position = 0
+        self.stroke_time = 150.0  # s from closed to open
+        self.position_error = 0.0  # Estimated, in position units
+        self.last_on_time = 0  # ms the relay was energized in the last pulse
+        self.calibration = None  # Step of a running calibrate()
+        self.events = None  # Set by SystemController
+
+        # Optional (closed, open) end stop switches, active low
+        self.end_stops = end_stops
+        if end_stops is not None:
+            for pin in end_stops:
+                pin.irq(trigger=Pin.IRQ_FALLING, handler=self._end_stop)
+
+        self._pulse_start = None  # ticks_ms when the running pulse started
+        self._pulse_length = 0  # ms asked for
+        self._pulse_end = None  # ticks_ms when the timer released the relay
+        self._homing = False  # The running pulse goes on against an end stop
+        self._at_stop = False  # An end stop switch ended the running pulse
+        self._return_to = 0  # Position to go back to after a calibration
 
     def refresh(self):
-        if self.adjusting > 0:
-            self.adjusting = max(0, self.adjusting - 1)
+        """ Books a finished pulse into the position and counts down the
+        running one. Only does bookkeeping, the timer ends the pulse. """
+        if self._pulse_start is None:
+            return
+        if self._pulse_end is not None:
+            self._finish()
+            if self.calibration is not None:
+                self._calibrate_step()
+            return
+        elapsed = time.ticks_diff(time.ticks_ms(), self._pulse_start)
+        adjusting = max(0, (self._pulse_length - elapsed + 999) // 1000)
+        if adjusting != self.adjusting:
+            self.adjusting = adjusting
+            self._emit("valve_adjusting", adjusting)
+
+    def _release(self, timer):
+        # Timer callback, keep it short and free of allocations
+        self.pin_open.value(1)
+        self.pin_close.value(1)
+        if self._pulse_end is None:
+            self._pulse_end = time.ticks_ms()
+
+    def _end_stop(self, pin):
+        # Pin interrupt, only ends a pulse that runs towards this stop
+        closed, opened = self.end_stops
+        if self._pulse_start is not None and self._pulse_end is None and (
+                (pin is closed and self.closing) or (pin is opened and self.opening)):
+            self.timer.deinit()
+            self._at_stop = True
+            self._release(None)
+
+    def _stop_reached(self, opening):
+        if self.end_stops is None:
+            return False
+        return self.end_stops[1 if opening else 0].value() == 0
+
+    def _finish(self):
+        on_time = time.ticks_diff(self._pulse_end, self._pulse_start)
+        self.last_on_time = on_time
+        moved = on_time / 1000 * FULL / self.stroke_time
+        tracked = self.position + moved if self.opening else self.position - moved
+        if self._at_stop or (self._homing and self.end_stops is None):
+            # Ran into the end stop, so the position is known again
+            end = FULL if self.opening else 0
+            logger.debug("Re-homed at %d, tracked position was %.1f", end, tracked)
+            self.position = end
+            self._set_error(0.0)
         else:
-            self.pin_close.value(1)
-            self.pin_open.value(1)
-            self.opening = False
-            self.closing = False
-        if self.closing:
-            self.position = max(0, self.position - 1)
-            self.pin_close.value(0)
-        elif self.opening:
-            self.position = min(150, self.position + 1)
-            self.pin_open.value(0)
+            self.position = max(0, min(FULL, tracked))
+            self._set_error(self.position_error + PULSE_ERROR + MOVE_ERROR * moved)
+        self.opening = False
+        self.closing = False
+        self.adjusting = 0
+        self._pulse_start = None
+        self._emit("valve_adjusting", 0)
+        self._emit("valve_position", self.position)
+
+    def _set_error(self, error):
+        self.position_error = min(error, FULL)
+        self._emit("valve_position_error", self.position_error)
+
+    def run_time(self, distance):
+        """ Seconds it takes to move the valve by `distance` position units. """
+        return distance * self.stroke_time / FULL
+
+    def _start(self, opening, duration, homing=False):
+        length = int(duration * 1000)
+        if length <= 0 or self._stop_reached(opening):
+            return False
+        pin = self.pin_open if opening else self.pin_close
+        self._pulse_length = length
+        self._pulse_end = None
+        self._homing = homing
+        self._at_stop = False
+        self.opening = opening
+        self.closing = not opening
+        pin.value(0)
+        self._pulse_start = time.ticks_ms()
+        self.timer.init(mode=Timer.ONE_SHOT, period=length, callback=self._release)
+        self.adjusting = (length + 999) // 1000
+        self._emit("valve_adjusting", self.adjusting)
+        return True
+
+    def _move(self, opening, duration):
+        # A move that reaches the end stop runs on against it, far enough to
+        # cover the estimated error, and re-homes the position
+        remaining = self.run_time(FULL - self.position if opening else self.position)
+        homing = remaining <= duration
+        if homing:
+            duration = remaining + HOMING_MARGIN + self.run_time(self.position_error)
+        return self._start(opening, duration, homing)
+
+    def _emit(self, name, value):
+        if self.events is not None:
+            self.events.emit(VALVE, name, value)
 
     def adjust(self, amount):
+        """ Runs the valve for `amount` seconds, negative to close. Returns
+        whether a pulse was started, e.g. not while one is still running. """
         if amount < 0:
-            self.close(duration=int(-amount))
-        elif amount > 0:
-            self.open(duration=int(amount))
+            return self.close(duration=-amount)
+        if amount > 0:
+            return self.open(duration=amount)
+        return False
 
     def close(self, duration=1):
-        if self.adjusting or self.position <= 0:
-            return
-
-        # If closing would reach or pass fully closed position
-        # add extra time to ensure complete closure
-        if self.position <= duration:
-            duration = self.position + 5
-
-        self.adjusting = duration
-        self.closing = True
+        if self._pulse_start is not None or self.calibration is not None or self.position <= 0:
+            return False
+        return self._move(False, duration)
 
     def open(self, duration=1):
-        if self.adjusting or self.position >= 150:
+        if self._pulse_start is not None or self.calibration is not None or self.position >= FULL:
+            return False
+        return self._move(True, duration)
+
+    def calibrate(self):
+        """ Homes at the closed end stop, measures the stroke to the open
+        one when there are end stop switches, and returns to the position
+        it started from. Runs from `refresh()`, other moves wait. """
+        if self.calibration is not None:
             return
-        self.adjusting = duration
-        self.opening = True
+        if self._pulse_start is not None:
+            self.timer.deinit()
+            self._release(None)
+            self._finish()
+        logger.info("Calibrating valve")
+        self._return_to = self.position
+        self.calibration = "closing"
+        # Closing from a wrong position estimate, run the full stroke and more
+        if not self._start(False, self.run_time(FULL) + HOMING_MARGIN, homing=True):
+            self.position = 0  # Already on the closed end stop
+            self._set_error(0.0)
+            self._calibrate_step()
+
+    def _calibrate_step(self):
+        step = self.calibration
+        if step == "closing" and self.end_stops is not None:
+            self.calibration = "opening"
+            if self._start(True, self.run_time(FULL) * 1.5, homing=True):
+                return
+            logger.warning("Valve open end stop already active, calibration aborted")
+        elif step == "opening":
+            if self._at_stop:
+                self.stroke_time = self.last_on_time / 1000
+                self._emit("valve_stroke_time", self.stroke_time)
+                logger.info("Measured valve stroke time %.1f s", self.stroke_time)
+            else:
+                logger.warning("Valve open end stop not reached, stroke time kept")
+            self.calibration = "returning"
+            if self._start(False, self.run_time(FULL - self._return_to)):
+                return
+        elif step == "closing":
+            self.calibration = "returning"
+            if self._start(True, self.run_time(self._return_to)):
+                return
+        self.calibration = None
+        logger.info("Valve calibration done at %.1f", self.position)